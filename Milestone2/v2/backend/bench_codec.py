@@ -0,0 +1,74 @@
+import sys
+import time
+from array import array
+
+from json import dumps as jdumps, loads as jloads
+from codec import encode_varbyte, decode_varbyte, encode_gaps, decode_gaps
+from disk_index import DiskIndex
+
+# Compares the compressed postings against the raw integer encodings they replaced:
+# JSON integer lists (table.json) and fixed width uint32 arrays (index version 2)
+# usage: python bench_codec.py <index dir> [max terms]
+
+
+def _time(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python bench_codec.py <index dir> [max terms]")
+        sys.exit(1)
+
+    index = DiskIndex(sys.argv[1])
+    max_terms = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    doc_lists = []
+    pos_lists = []
+    for n, (token, postings) in enumerate(index.items()):
+        if max_terms is not None and n >= max_terms:
+            break
+        doc_lists.append(postings.doc_ids.tolist())
+        pos_lists.extend(postings.idx_list(i).tolist() for i in range(len(postings)))
+
+    num_postings = len(pos_lists)
+    num_positions = sum(len(p) for p in pos_lists)
+
+    json_docs = [jdumps(d) for d in doc_lists]
+    json_pos = [jdumps(p) for p in pos_lists]
+    raw_docs = [array('I', d).tobytes() for d in doc_lists]
+    raw_pos = [array('I', p).tobytes() for p in pos_lists]
+    vb_docs = [bytes(encode_gaps(d, bytearray())) for d in doc_lists]
+    vb_pos = [bytes(encode_gaps(p, bytearray())) for p in pos_lists]
+    vb_plain_pos = [bytes(encode_varbyte(p, bytearray())) for p in pos_lists]
+
+    formats = {
+        'json': (json_docs, json_pos,
+                 lambda: [jloads(d) for d in json_docs],
+                 lambda: [jloads(p) for p in json_pos]),
+        'uint32': (raw_docs, raw_pos,
+                   lambda: [array('I', d) for d in raw_docs],
+                   lambda: [array('I', p) for p in raw_pos]),
+        'varbyte': (vb_docs, vb_plain_pos,
+                    lambda: [decode_varbyte(d, 0, len(l)) for d, l in zip(vb_docs, doc_lists)],
+                    lambda: [decode_varbyte(p, 0, len(l)) for p, l in zip(vb_plain_pos, pos_lists)]),
+        'gap+varbyte': (vb_docs, vb_pos,
+                        lambda: [decode_gaps(d, 0, len(l)) for d, l in zip(vb_docs, doc_lists)],
+                        lambda: [decode_gaps(p, 0, len(l)) for p, l in zip(vb_pos, pos_lists)]),
+    }
+
+    print(f'Terms: {len(doc_lists)}, postings: {num_postings}, positions: {num_positions}')
+    print(f'{"format":<14}{"doc id B/posting":>18}{"pos B/posting":>16}{"doc ids/s":>14}{"positions/s":>14}')
+    for name, (docs, pos, decode_docs, decode_pos) in formats.items():
+        doc_bytes = sum(len(d) for d in docs)
+        pos_bytes = sum(len(p) for p in pos)
+        doc_rate = num_postings / _time(decode_docs) if num_postings else 0
+        pos_rate = num_positions / _time(decode_pos) if num_positions else 0
+        print(f'{name:<14}{doc_bytes / num_postings:>18.2f}{pos_bytes / num_postings:>16.2f}'
+              f'{doc_rate:>14.0f}{pos_rate:>14.0f}')
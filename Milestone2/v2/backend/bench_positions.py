@@ -0,0 +1,41 @@
+import random
+import sys
+import time
+from collections import Counter
+
+from postings import token_positions
+
+# Times per-document positional posting construction on large synthetic pages:
+# the previous per-token rescan of the token list against the single pass
+# usage: python bench_positions.py [page tokens ...]
+
+
+def rescan_positions(tokens):
+    token_dict = Counter(tokens)
+    return {token: [i for i in range(len(tokens)) if tokens[i] == token] for token in token_dict}
+
+
+def _time(fn, tokens, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(tokens)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 50000]
+    random.seed(0)
+    # Zipf-like vocabulary, as on real pages a few terms dominate
+    vocab = [f'term{i}' for i in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocab))]
+
+    print(f'{"tokens":>8}{"distinct":>10}{"rescan (s)":>14}{"single pass (s)":>18}{"speedup":>10}')
+    for size in sizes:
+        tokens = random.choices(vocab, weights, k=size)
+        assert rescan_positions(tokens) == token_positions(tokens)
+        before = _time(rescan_positions, tokens, repeat=1 if size > 10000 else 3)
+        after = _time(token_positions, tokens)
+        print(f'{size:>8}{len(set(tokens)):>10}{before:>14.4f}{after:>18.4f}{before / after:>10.0f}x')
@@ -0,0 +1,66 @@
+import random
+import sys
+import time
+
+import numpy as np
+
+from index import Indexer
+from postings import PostingList
+from search import SearchEngine
+from bench_search import _percentile
+
+# Query latency of exhaustive ('all') against pruned ('wand', 'impact') retrieval on a
+# synthetic in-memory index, with every ranking model
+# usage: python bench_retrieval.py [documents] [repeat]
+
+# Share of the documents each term occurs in
+TERMS = {'uci': 0.9, 'ics': 0.6, 'computer': 0.3, 'learning': 0.1, 'rare': 0.002}
+QUERIES = ["uci ics", "uci ics computer", "computer learning", "uci learning", "rare uci", "ics"]
+MODES = ['all', 'wand', 'impact']
+
+
+def build_index(num_docs, seed=0):
+    # Documents of log-normal length; each term occurs in a random share of them, a
+    # geometric number of times at random positions
+    random.seed(seed)
+    rng = np.random.default_rng(seed)
+    indexer = Indexer(None, None, None)
+    lengths = np.clip(rng.lognormal(5.5, 0.8, num_docs), 20, 5000).astype(np.int64)
+    for doc_id in range(num_docs):
+        indexer.docs.add(str(doc_id), f'doc/{doc_id}', None, int(lengths[doc_id]))
+    for term, share in TERMS.items():
+        doc_ids = np.sort(rng.choice(num_docs, max(1, int(share * num_docs)), replace=False))
+        counts = np.minimum(rng.geometric(0.4, len(doc_ids)), lengths[doc_ids])
+        postings = PostingList()
+        for doc_id, count in zip(doc_ids.tolist(), counts.tolist()):
+            postings.append(doc_id, count, sorted(random.sample(range(lengths[doc_id]), count)))
+        indexer.inverted_index[term] = postings
+    indexer.num_documents = num_docs
+    indexer._update_ii()
+    return indexer
+
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    start = time.perf_counter()
+    indexer = build_index(num_docs)
+    print(f'{num_docs} documents, built in {time.perf_counter() - start:.1f}s')
+
+    for scorer in ['classic', 'bm25f']:
+        # Queries are given as their tokens, and repeats must rank them again
+        search_engine = SearchEngine(indexer, None, result_cache_size=0, scorer=scorer)
+        print(f'\nscorer {scorer}, median ms')
+        print(f'{"query":<24}{"results":>9}' + ''.join(f'{mode:>10}' for mode in MODES))
+        for query in QUERIES:
+            row = []
+            for mode in MODES:
+                times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    parsed = search_engine._parse(query, query.split(), search_engine._snapshot())
+                    response = search_engine._search(parsed, 20, mode)
+                    times.append((time.perf_counter() - start) * 1000)
+                row.append(_percentile(times, 50))
+            print(f'{query:<24}{response[0]:>9}' + ''.join(f'{ms:>10.1f}' for ms in row))
@@ -0,0 +1,47 @@
+import sys
+import time
+
+from index import Indexer
+from search import SearchEngine
+
+# Measures end-to-end SearchEngine.search latency over an index
+# usage: python bench_search.py <index dir> [queries file] [repeat] [scorer]
+
+DEFAULT_QUERIES = ["uci", "ics", "computer science", "machine learning",
+                   "informatics research student", "software systems network security"]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python bench_search.py <index dir> [queries file] [repeat] [scorer]")
+        sys.exit(1)
+
+    queries = DEFAULT_QUERIES
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'r') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    scorer = sys.argv[4] if len(sys.argv) > 4 else 'classic'
+
+    indexer = Indexer(None, None, None)
+    indexer.load_index(sys.argv[1])
+    # Repeats must rank the query again, so no results are cached
+    search_engine = SearchEngine(indexer, None, result_cache_size=0, scorer=scorer)
+
+    print(f'{"query":<40}{"results":>9}{"p50 ms":>10}{"p95 ms":>10}')
+    all_times = []
+    for query in queries:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = search_engine.search(query)
+            times.append((time.perf_counter() - start) * 1000)
+        all_times.extend(times)
+        num_results = response[0] if response else 0
+        print(f'{query[:39]:<40}{num_results:>9}{_percentile(times, 50):>10.2f}{_percentile(times, 95):>10.2f}')
+    print(f'{"all":<40}{"":>9}{_percentile(all_times, 50):>10.2f}{_percentile(all_times, 95):>10.2f}')
@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+from collections import Counter
+from itertools import islice
+
+from lxml import html
+from json import load as jload
+from token_utils import TokenUtils
+
+# Compares tokenizer throughput and output against the original full-pipeline,
+# one-document-at-a-time path on the first N pages of the corpus
+# usage: python bench_tokenizer.py <pages dir> [num pages] [n_process]
+
+
+def _load_texts(pages_path, num_pages):
+    with open(os.path.join(pages_path, 'bookkeeping.json'), 'r') as f:
+        urls = jload(f)
+    texts = []
+    for loc, url in islice(urls.items(), num_pages):
+        root = html.parse(os.path.join(pages_path, loc.replace('/', '\\'))).getroot()
+        if root is not None and root.text_content():
+            texts.append(str(root.text_content()))
+    return texts
+
+
+def _run(name, fn, reference=None):
+    start = time.perf_counter()
+    token_lists = fn()
+    elapsed = time.perf_counter() - start
+
+    num_tokens = sum(len(tokens) for tokens in token_lists)
+    line = f'{name:<28}{num_tokens / elapsed:>14.0f}'
+    if reference is not None:
+        same_docs = sum(a == b for a, b in zip(reference, token_lists))
+        ref_terms = sum((Counter(a) & Counter(b)).total() for a, b in zip(reference, token_lists))
+        ref_total = sum(len(a) for a in reference)
+        line += f'{100 * same_docs / len(reference):>14.1f}%{100 * ref_terms / ref_total:>14.1f}%'
+    print(line)
+    return token_lists
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python bench_tokenizer.py <pages dir> [num pages] [n_process]")
+        sys.exit(1)
+
+    num_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    n_process = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    texts = _load_texts(sys.argv[1], num_pages)
+    full = TokenUtils(full_pipeline=True)
+    trimmed = TokenUtils()
+
+    print(f'{len(texts)} pages')
+    print(f'{"tokenizer":<28}{"tokens/sec":>14}{"same docs":>15}{"same terms":>15}')
+    reference = _run('full pipeline, per doc', lambda: [full.tokenize(text) for text in texts])
+    _run('trimmed, per doc', lambda: [trimmed.tokenize(text) for text in texts], reference)
+    _run('trimmed, nlp.pipe', lambda: trimmed.tokenize_many(texts), reference)
+    _run(f'trimmed, nlp.pipe x{n_process}', lambda: trimmed.tokenize_many(texts, n_process=n_process), reference)
+    _run('lookup fast path (cold)', lambda: [trimmed.tokenize_fast(text) for text in texts], reference)
+    _run('lookup fast path (warm)', lambda: [trimmed.tokenize_fast(text) for text in texts], reference)
@@ -0,0 +1,60 @@
+import argparse
+import time
+from index import Indexer
+
+# Builds the on-disk index from the raw pages without starting the search backend
+# usage: python build_index.py --workers 8
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the inverted index from WEBPAGES_RAW")
+    parser.add_argument("--pages", default=r"..\..\..\WEBPAGES_RAW", help="directory holding bookkeeping.json")
+    parser.add_argument("--index", default=r"..\..\index", help="output index directory")
+    parser.add_argument("--logs", default=r"..\..\logs.txt", help="analytics log file")
+    parser.add_argument("--workers", type=int, default=1, help="number of build processes")
+    parser.add_argument("--batch-size", type=int, default=64, help="pages tokenized per nlp.pipe batch")
+    parser.add_argument("--tokenizer-processes", type=int, default=1,
+                        help="nlp.pipe processes per build process (serial and memory budget builds)")
+    parser.add_argument("--readers", type=int, default=2, help="threads reading page files")
+    parser.add_argument("--parsers", type=int, default=2, help="threads parsing HTML and extracting text")
+    parser.add_argument("--tokenizers", type=int, default=1,
+                        help="threads tokenizing page batches, each with its own spaCy model")
+    parser.add_argument("--queue-size", type=int, default=256, help="pages held by each queue between stages")
+    parser.add_argument("--memory-budget", type=int, default=None,
+                        help="build with bounded memory, flushing runs to disk every N megabytes")
+    parser.add_argument("--impact-ordered", action="store_true",
+                        help="also store each term's postings order by decreasing impact")
+    parser.add_argument("--limit", type=int, default=None, help="only index the first N bookkeeping entries")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="split the documents into N shard indexes, each served by its own process")
+    parser.add_argument("--update", action="store_true",
+                        help="only index pages added, changed or removed since the last build into a new segment")
+    parser.add_argument("--compact", action="store_true",
+                        help="merge all segments of an updated index into one")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    indexer = Indexer(args.pages, None, args.logs, doc_limit=args.limit,
+                      batch_size=args.batch_size, n_process=args.tokenizer_processes,
+                      stage_workers={'read': args.readers, 'parse': args.parsers, 'tokenize': args.tokenizers},
+                      queue_size=args.queue_size)
+    if args.update or args.compact:
+        if args.update:
+            indexer.update_index(args.index)
+        if args.compact:
+            indexer.compact_index(args.index)
+        print(f"Updated index in {time.perf_counter() - start:.1f}s")
+    elif args.shards is not None:
+        indexer.construct_shards(args.index, args.shards, workers=args.workers)
+        print(f"Built {args.shards} shards in {time.perf_counter() - start:.1f}s")
+    elif args.memory_budget is not None:
+        indexer.construct_index_spimi(args.index, args.memory_budget * 1024 * 1024, args.impact_ordered)
+        print(f"Built index in {time.perf_counter() - start:.1f}s within a {args.memory_budget}MB budget")
+    else:
+        indexer.construct_index(workers=args.workers)
+        indexer.save_index(args.index, args.impact_ordered)
+        indexer.load_index(args.index)
+        print(f"Built index in {time.perf_counter() - start:.1f}s with {args.workers} worker(s)")
+
+    # Shards are separate indexes, there is no single index to report on
+    if args.shards is None:
+        indexer.save_analytics()
+        indexer.print_analytics()
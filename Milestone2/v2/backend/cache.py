@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache():
+
+    def __init__(self, maxsize, ttl=None):
+        # ttl: seconds an entry stays valid after it was stored, or None to keep it
+        # until it is evicted
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Searches may run concurrently in a thread pool
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            value, expires = self.entries[key]
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class LFUCache():
+
+    def __init__(self, max_bytes):
+        # Bounded by the summed size of its values; evicts the least frequently used
+        # entry, the least recently used one among equally frequent entries
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.entries = {}
+        # use count -> keys with that count, in recency order
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _touch(self, key, count, uses):
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+        self.buckets.setdefault(count + uses, OrderedDict())[key] = None
+        return count + uses
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            value, size, count = self.entries[key]
+            self.entries[key] = (value, size, self._touch(key, count, 1))
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size, uses=1):
+        # uses seeds the use count, e.g. from query log frequencies when warming up.
+        # Returns False when the value does not fit in the cache at all.
+        with self.lock:
+            if size > self.max_bytes:
+                return False
+            if key in self.entries:
+                _, old_size, count = self.entries[key]
+                self.used -= old_size
+                count = self._touch(key, count, uses)
+            else:
+                count = uses
+                self.buckets.setdefault(count, OrderedDict())[key] = None
+            self.entries[key] = (value, size, count)
+            self.used += size
+
+            while self.used > self.max_bytes:
+                min_count = min(self.buckets)
+                bucket = self.buckets[min_count]
+                victim, _ = bucket.popitem(last=False)
+                if not bucket:
+                    del self.buckets[min_count]
+                self.used -= self.entries.pop(victim)[1]
+                self.evictions += 1
+            return key in self.entries
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+            self.used = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'bytes': self.used, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
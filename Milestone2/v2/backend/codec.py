@@ -0,0 +1,57 @@
+from array import array
+
+
+# Variable-byte integers: 7 bits per byte, high bit set on every byte but the last
+
+def encode_varbyte(values, out):
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return out
+
+
+def decode_varbyte(buf, offset, n):
+    values = array('I')
+    for _ in range(n):
+        value = shift = 0
+        byte = buf[offset]
+        while byte >= 0x80:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            offset += 1
+            byte = buf[offset]
+        values.append(value | (byte << shift))
+        offset += 1
+    return values, offset
+
+
+# Sorted lists (doc ids, positions) are stored as gaps from the previous value;
+# prev is the value before the first, for a list stored in several blocks
+
+def encode_gaps(values, out, prev=0):
+    for value in values:
+        gap = value - prev
+        while gap >= 0x80:
+            out.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        out.append(gap)
+        prev = value
+    return out
+
+
+def decode_gaps(buf, offset, n, prev=0):
+    values = array('I')
+    for _ in range(n):
+        value = shift = 0
+        byte = buf[offset]
+        while byte >= 0x80:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            offset += 1
+            byte = buf[offset]
+        prev += value | (byte << shift)
+        values.append(prev)
+        offset += 1
+    return values, offset
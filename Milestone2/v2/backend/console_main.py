@@ -5,21 +5,25 @@ from search import SearchEngine
 if __name__ == "__main__":
     PAGES_PATH = r"..\..\..\WEBPAGES_RAW"
     II_PATH = r"..\..\table.json"
+    INDEX_DIR = r"..\..\index"
     LOGS_PATH = r"..\..\logs.txt"
+    QUERY_LOG_PATH = r"..\..\queries.txt"
         
     indexer = Indexer(PAGES_PATH, II_PATH, LOGS_PATH)
 
-    if os.path.isfile(II_PATH):
-        indexer.load_table()
-    else:
-        inverted_index = indexer.construct_index()
-        indexer.save_table()
+    if not os.path.isdir(INDEX_DIR):
+        if os.path.isfile(II_PATH):
+            indexer.load_table()
+        else:
+            inverted_index = indexer.construct_index()
+        indexer.save_index(INDEX_DIR)
+    indexer.load_index(INDEX_DIR)
 
     # indexer.print_ii()
     indexer.save_analytics()
     indexer.print_analytics()
 
-    search_engine = SearchEngine(indexer, LOGS_PATH)
+    search_engine = SearchEngine(indexer, LOGS_PATH, query_log_path=QUERY_LOG_PATH)
 
     query = input("Enter your query: ")
     while query:
@@ -0,0 +1,17 @@
+import sys
+from index import Indexer
+
+# Migrates a legacy table.json into the binary on-disk index format
+# usage: python convert_table.py <table.json> <index dir>
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python convert_table.py <table.json> <index dir>")
+        sys.exit(1)
+
+    II_PATH, INDEX_DIR = sys.argv[1], sys.argv[2]
+
+    indexer = Indexer(None, II_PATH, None)
+    indexer.load_table()
+    indexer.save_index(INDEX_DIR)
+
+    print(f"Converted {II_PATH} ({indexer.num_unique_words} terms) into {INDEX_DIR}")
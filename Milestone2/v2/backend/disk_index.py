@@ -0,0 +1,469 @@
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+from json import load as jload, dump as jdump
+from codec import encode_varbyte, decode_varbyte, encode_gaps, decode_gaps
+from postings import PostingList, FIELDS
+from cache import LFUCache
+
+
+INDEX_VERSION = 7
+
+META_FILE = 'meta.json'
+TERMS_IDX = 'terms.idx'
+TERMS_DAT = 'terms.dat'
+POSTINGS_DAT = 'postings.dat'
+DOCS_IDX = 'docs.idx'
+DOCS_DAT = 'docs.dat'
+DOCS_LEN = 'lengths.dat'
+DOCS_NORM = 'norms.dat'
+DOCS_FIELDS = 'fields.dat'
+
+# term offset, term length, postings offset, postings length, document frequency
+TERM_ENTRY = struct.Struct('<QIQII')
+# doc record offset
+DOC_ENTRY = struct.Struct('<Q')
+# loc length, url length, title length
+DOC_HEADER = struct.Struct('<III')
+# Postings per skip block: doc ids, counts and position block sizes are stored in
+# blocks of this many postings, with a skip entry per block for longer lists
+SKIP_BLOCK = 128
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _create(path, mode='wb'):
+    # A new file rather than one truncated in place: the name may still be a hard link
+    # into a segment (see segments.migrate_index) that a running server maps
+    if os.path.exists(path):
+        os.remove(path)
+    return open(path, mode)
+
+
+def _column(col, buf, offset, n):
+    end = offset + col.itemsize * n
+    col.frombytes(buf[offset:end])
+    return end
+
+
+def _num_skips(df):
+    # A list of one skip block has no skip entries
+    return -(-df // SKIP_BLOCK) if df > SKIP_BLOCK else 0
+
+
+# Postings block: for lists longer than SKIP_BLOCK, a skip entry per skip block (its
+# last doc id, and where its postings and its positions end). Then per skip block,
+# doc id gaps, counts and position block sizes as varbytes; then raw tag and field
+# frequency columns, then the gap-encoded position blocks and, for impact ordered
+# indexes, the posting indices by decreasing impact
+def pack_postings(postings, impacts=None):
+    df = len(postings)
+    head = bytearray()
+    skips = array('I')
+    prev = 0
+    for start in range(0, df, SKIP_BLOCK):
+        end = min(start + SKIP_BLOCK, df)
+        encode_gaps(postings.doc_ids[start:end], head, prev)
+        encode_varbyte(postings.counts[start:end], head)
+        encode_varbyte([postings.offsets[i + 1] - postings.offsets[i] for i in range(start, end)], head)
+        prev = postings.doc_ids[end - 1]
+        skips.extend([prev, len(head), postings.offsets[end] - postings.offsets[0]])
+
+    return b''.join([skips.tobytes() if _num_skips(df) else b'',
+                     head,
+                     postings.tags.tobytes(),
+                     postings.fields.tobytes(),
+                     postings.positions[postings.offsets[0]:postings.offsets[-1]],
+                     impacts.tobytes() if impacts is not None else b''])
+
+
+def unpack_postings(buf, offset, df, impact_ordered=False):
+    postings = PostingList()
+    offset += _num_skips(df) * 3 * 4
+    sizes = array('I')
+    prev = 0
+    for start in range(0, df, SKIP_BLOCK):
+        n = min(SKIP_BLOCK, df - start)
+        doc_ids, offset = decode_gaps(buf, offset, n, prev)
+        counts, offset = decode_varbyte(buf, offset, n)
+        block_sizes, offset = decode_varbyte(buf, offset, n)
+        postings.doc_ids.extend(doc_ids)
+        postings.counts.extend(counts)
+        sizes.extend(block_sizes)
+        prev = doc_ids[-1]
+    offset = _column(postings.tags, buf, offset, df)
+    offset = _column(postings.fields, buf, offset, df * len(FIELDS))
+
+    for size in sizes:
+        postings.offsets.append(postings.offsets[-1] + size)
+    # Position blocks stay encoded until PostingList.idx_list asks for one
+    postings.positions = buf[offset:offset + postings.offsets[-1]]
+    if impact_ordered:
+        postings.impacts = array('I')
+        _column(postings.impacts, buf, offset + postings.offsets[-1], df)
+    return postings
+
+
+class BlockDocIds():
+
+    # Doc ids of BlockPostings as a sequence for retrieval.intersect
+    def __init__(self, postings):
+        self.postings = postings
+
+    def __len__(self):
+        return self.postings.df
+
+    def __getitem__(self, i):
+        return self.postings.block(i // SKIP_BLOCK)[0][i % SKIP_BLOCK]
+
+    def __iter__(self):
+        for b in range(len(self.postings.last_doc_ids)):
+            yield from self.postings.block(b)[0]
+
+    def gallop(self, target, lo=0):
+        # Index of the first doc id >= target at or after lo: the skip entries find
+        # its skip block, and only that block is decoded
+        postings = self.postings
+        b = lo // SKIP_BLOCK
+        if lo >= postings.df or postings.last_doc_ids[b] < target:
+            b = bisect_left(postings.last_doc_ids, target, b + 1)
+            if b >= len(postings.last_doc_ids):
+                return postings.df
+            lo = b * SKIP_BLOCK
+        return b * SKIP_BLOCK + bisect_left(postings.block(b)[0], target, lo - b * SKIP_BLOCK)
+
+
+class BlockPostings():
+
+    # Packed postings of a list with skip entries, decoded a skip block at a time. A
+    # conjunctive query gallops through the doc ids, decoding only the skip blocks
+    # it lands in, and reads the other columns of the postings it matches alone.
+    def __init__(self, buf, offset, df):
+        self.buf = buf
+        self.df = df
+        skips = array('I')
+        offset = _column(skips, buf, offset, _num_skips(df) * 3)
+        self.last_doc_ids = skips[0::3]
+        self.block_ends = skips[1::3]
+        self.position_ends = skips[2::3]
+        self.head = offset
+        self.tags_offset = offset + self.block_ends[-1]
+        self.fields_offset = self.tags_offset + df
+        self.positions_offset = self.fields_offset + df * len(FIELDS)
+        self.doc_ids = BlockDocIds(self)
+        # skip block -> decoded doc ids and the offset after them; counts and position
+        # offsets of the skip blocks whose other columns were read
+        self.blocks = {}
+        self.columns = {}
+
+    def __len__(self):
+        return self.df
+
+    def block(self, b):
+        if b not in self.blocks:
+            start = self.head + (self.block_ends[b - 1] if b else 0)
+            prev = self.last_doc_ids[b - 1] if b else 0
+            self.blocks[b] = decode_gaps(self.buf, start, min(SKIP_BLOCK, self.df - b * SKIP_BLOCK), prev)
+        return self.blocks[b]
+
+    def _columns(self, b):
+        if b not in self.columns:
+            doc_ids, offset = self.block(b)
+            counts, offset = decode_varbyte(self.buf, offset, len(doc_ids))
+            sizes, _ = decode_varbyte(self.buf, offset, len(doc_ids))
+            offsets = array('I', [self.position_ends[b - 1] if b else 0])
+            for size in sizes:
+                offsets.append(offsets[-1] + size)
+            self.columns[b] = counts, offsets
+        return self.columns[b]
+
+    def idx_list(self, i):
+        counts, offsets = self._columns(i // SKIP_BLOCK)
+        j = i % SKIP_BLOCK
+        return decode_gaps(self.buf, self.positions_offset + offsets[j], counts[j])[0]
+
+    def select(self, indices, doc_ids):
+        # Decoded PostingList of the postings at the sorted indices, as PostingList.select
+        selected = PostingList()
+        selected.doc_ids = array('I', doc_ids)
+        width = len(FIELDS)
+        for i in indices:
+            counts, offsets = self._columns(i // SKIP_BLOCK)
+            j = i % SKIP_BLOCK
+            selected.counts.append(counts[j])
+            selected.tags.append(self.buf[self.tags_offset + i])
+            selected.fields.frombytes(self.buf[self.fields_offset + i * width:self.fields_offset + (i + 1) * width])
+            selected.positions += self.buf[self.positions_offset + offsets[j]:self.positions_offset + offsets[j + 1]]
+            selected.offsets.append(len(selected.positions))
+        return selected
+
+
+class IndexWriter():
+
+    def __init__(self, index_dir, impact_norms=None):
+        self.index_dir = index_dir
+        # With the final document norms known up front, postings also get an impact order
+        self.impact_norms = impact_norms
+        self.lengths = array('I')
+        os.makedirs(index_dir, exist_ok=True)
+
+        self.terms_idx = _create(os.path.join(index_dir, TERMS_IDX))
+        self.terms_dat = _create(os.path.join(index_dir, TERMS_DAT))
+        self.postings_dat = _create(os.path.join(index_dir, POSTINGS_DAT))
+        self.docs_idx = _create(os.path.join(index_dir, DOCS_IDX))
+        self.docs_dat = _create(os.path.join(index_dir, DOCS_DAT))
+        self.docs_len = _create(os.path.join(index_dir, DOCS_LEN))
+        self.docs_fields = _create(os.path.join(index_dir, DOCS_FIELDS))
+
+        self.num_terms = 0
+        self.num_docs = 0
+        self.last_term = None
+
+
+    def add_document(self, loc, url, title, length, field_lengths=None):
+        loc_b = loc.encode('utf-8')
+        url_b = url.encode('utf-8')
+        title_b = (title or '').encode('utf-8')
+        self.docs_idx.write(DOC_ENTRY.pack(self.docs_dat.tell()))
+        self.docs_dat.write(DOC_HEADER.pack(len(loc_b), len(url_b), len(title_b)))
+        self.docs_dat.write(loc_b + url_b + title_b)
+        self.docs_len.write(array('I', [length]).tobytes())
+        self.lengths.append(length)
+        self.docs_fields.write(array('I', field_lengths or [0] * len(FIELDS)).tobytes())
+
+        doc_id = self.num_docs
+        self.num_docs += 1
+        return doc_id
+
+
+    def add_term(self, token, postings):
+        # Terms must arrive in byte order so the reader can binary search them
+        token_b = token.encode('utf-8')
+        if self.last_term is not None and token_b <= self.last_term:
+            raise ValueError(f'Terms must be added in sorted order: {token}')
+        self.last_term = token_b
+
+        impacts = postings.impact_order(self.impact_norms, self.lengths) if self.impact_norms is not None else None
+        block = pack_postings(postings, impacts)
+        self.terms_idx.write(TERM_ENTRY.pack(self.terms_dat.tell(), len(token_b),
+                                             self.postings_dat.tell(), len(block), len(postings)))
+        self.terms_dat.write(token_b)
+        self.postings_dat.write(block)
+        self.num_terms += 1
+
+
+    def close(self, num_documents, norms):
+        for f in (self.terms_idx, self.terms_dat, self.postings_dat,
+                  self.docs_idx, self.docs_dat, self.docs_len, self.docs_fields):
+            f.close()
+        with _create(os.path.join(self.index_dir, DOCS_NORM)) as f:
+            f.write(array('d', norms).tobytes())
+
+        meta = {'version': INDEX_VERSION,
+                'num_documents': num_documents,
+                'unique_words': self.num_terms,
+                'num_docs_stored': self.num_docs,
+                'impact_ordered': self.impact_norms is not None}
+        with _create(os.path.join(self.index_dir, META_FILE), 'w') as f:
+            jdump(meta, f)
+
+
+class DiskDocTable():
+
+    def __init__(self, index_dir):
+        self.docs_idx = _map(os.path.join(index_dir, DOCS_IDX))
+        self.docs_dat = _map(os.path.join(index_dir, DOCS_DAT))
+        self.lengths = memoryview(_map(os.path.join(index_dir, DOCS_LEN))).cast('I')
+        self.norms = memoryview(_map(os.path.join(index_dir, DOCS_NORM))).cast('d')
+        self.field_lengths = memoryview(_map(os.path.join(index_dir, DOCS_FIELDS))).cast('I')
+        self.num_docs = len(self.docs_idx) // DOC_ENTRY.size
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, doc_id):
+        if not 0 <= doc_id < self.num_docs:
+            raise IndexError(doc_id)
+        offset, = DOC_ENTRY.unpack_from(self.docs_idx, doc_id * DOC_ENTRY.size)
+        loc_len, url_len, title_len = DOC_HEADER.unpack_from(self.docs_dat, offset)
+        start = offset + DOC_HEADER.size
+        loc = self.docs_dat[start:start + loc_len].decode('utf-8')
+        start += loc_len
+        url = self.docs_dat[start:start + url_len].decode('utf-8')
+        start += url_len
+        title = self.docs_dat[start:start + title_len].decode('utf-8') or None
+
+        return loc, url, title
+
+    def length(self, doc_id):
+        return self.lengths[doc_id]
+
+    def field_length(self, doc_id):
+        return self.field_lengths[doc_id * len(FIELDS):(doc_id + 1) * len(FIELDS)].tolist()
+
+
+class DiskIndex():
+
+    def __init__(self, index_dir, cache_bytes=0):
+        self.index_dir = index_dir
+        # Decoded postings of frequently queried terms, kept within cache_bytes
+        self.cache = LFUCache(cache_bytes) if cache_bytes > 0 else None
+
+        with open(os.path.join(index_dir, META_FILE), 'r') as f:
+            self.meta = jload(f)
+        if self.meta['version'] != INDEX_VERSION:
+            raise ValueError(f'Unsupported index version {self.meta["version"]} in {index_dir}')
+
+        self.terms_idx = _map(os.path.join(index_dir, TERMS_IDX))
+        self.terms_dat = _map(os.path.join(index_dir, TERMS_DAT))
+        self.postings_dat = _map(os.path.join(index_dir, POSTINGS_DAT))
+        self.docs = DiskDocTable(index_dir)
+        self.num_terms = len(self.terms_idx) // TERM_ENTRY.size
+
+
+    def _entry(self, i):
+        return TERM_ENTRY.unpack_from(self.terms_idx, i * TERM_ENTRY.size)
+
+
+    def _term(self, entry):
+        term_off, term_len = entry[0], entry[1]
+        return self.terms_dat[term_off:term_off + term_len]
+
+
+    def _find(self, token):
+        token_b = token.encode('utf-8')
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            term = self._term(entry)
+            if term < token_b:
+                lo = mid + 1
+            elif term > token_b:
+                hi = mid
+            else:
+                return entry
+        return None
+
+
+    def _read_postings(self, entry):
+        return unpack_postings(self.postings_dat, entry[2], entry[4], self.meta['impact_ordered'])
+
+
+    def _lookup(self, token):
+        if self.cache is not None:
+            postings = self.cache.get(token)
+            if postings is not None:
+                return postings
+        entry = self._find(token)
+        if entry is None:
+            return None
+        postings = self._read_postings(entry)
+        if self.cache is not None:
+            self.cache.put(token, postings, postings.nbytes())
+        return postings
+
+
+    def warm(self, token_uses):
+        # Preloads the most used terms first, seeding their use counts, until the
+        # cache is full
+        if self.cache is None:
+            return 0
+        loaded = 0
+        for token, uses in sorted(token_uses.items(), key=lambda x: -x[1]):
+            entry = self._find(token)
+            if entry is None or token in self.cache:
+                continue
+            postings = self._read_postings(entry)
+            if self.cache.used + postings.nbytes() > self.cache.max_bytes:
+                break
+            self.cache.put(token, postings, postings.nbytes(), uses)
+            loaded += 1
+        return loaded
+
+
+    def __len__(self):
+        return self.num_terms
+
+
+    def __contains__(self, token):
+        return self._find(token) is not None
+
+
+    def __getitem__(self, token):
+        postings = self._lookup(token)
+        if postings is None:
+            raise KeyError(token)
+        return postings
+
+
+    def get(self, token, default=None):
+        postings = self._lookup(token)
+        if postings is None:
+            return default
+        return postings
+
+
+    def get_blocks(self, token, probes):
+        # Postings for a conjunctive query whose shortest list has probes postings: a
+        # list with more skip blocks than that comes as BlockPostings, unless the cache
+        # holds it decoded. Galloping would land in most blocks of a shorter one.
+        entry = self._find(token)
+        if entry is None or _num_skips(entry[4]) <= probes or (self.cache is not None and token in self.cache):
+            return self.get(token)
+        return BlockPostings(self.postings_dat, entry[2], entry[4])
+
+
+    def doc_freq(self, token):
+        entry = self._find(token)
+        return entry[4] if entry is not None else 0
+
+
+    def doc_freqs(self):
+        # (term, df) pairs read from the term dictionary alone
+        for i in range(self.num_terms):
+            entry = self._entry(i)
+            yield self._term(entry).decode('utf-8'), entry[4]
+
+
+    def keys(self):
+        for i in range(self.num_terms):
+            yield self._term(self._entry(i)).decode('utf-8')
+
+
+    def items(self):
+        for i in range(self.num_terms):
+            entry = self._entry(i)
+            token = self._term(entry).decode('utf-8')
+            yield token, self._read_postings(entry)
+
+
+    def values(self):
+        for _, postings in self.items():
+            yield postings
+
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.index_dir, name))
+                   for name in os.listdir(self.index_dir))
+
+
+def write_index(index_dir, inverted_index, docs, num_documents, impact_ordered=False):
+    writer = IndexWriter(index_dir, docs.norms if impact_ordered else None)
+
+    for doc_id in range(len(docs)):
+        loc, url, title = docs[doc_id]
+        writer.add_document(loc, url, title, docs.length(doc_id), docs.field_length(doc_id))
+
+    for token in sorted(inverted_index, key=lambda t: t.encode('utf-8')):
+        writer.add_term(token, inverted_index[token])
+
+    writer.close(num_documents, docs.norms)
@@ -0,0 +1,78 @@
+import sys
+import time
+
+import numpy as np
+
+from index import Indexer
+from search import SearchEngine
+from bench_search import DEFAULT_QUERIES, _percentile
+
+# Ranking quality against latency of two-stage ranking at several rerank depths. There
+# are no relevance judgments, so the exhaustive ranking (every candidate scored by both
+# stages) is the reference: overlap is the share of its top k a depth still returns,
+# ndcg weighs each returned result by its reference rank, exact counts the queries
+# whose top k came back in the same order.
+# usage: python eval_rerank.py <index dir> [queries file] [depths] [scorer] [k]
+
+DEFAULT_DEPTHS = [20, 50, 100, 200, 500, 1000]
+
+
+def _ndcg(results, reference):
+    # Gain of a reference result at rank i of k is k - i
+    gains = {url: len(reference) - i for i, url in enumerate(reference)}
+    dcg = sum(gains.get(url, 0) / np.log2(i + 2) for i, url in enumerate(results))
+    ideal = sum(gain / np.log2(i + 2) for i, gain in enumerate(sorted(gains.values(), reverse=True)))
+    return dcg / ideal if ideal else 1.0
+
+
+def _run(search_engine, queries, k, repeat=3):
+    # Result urls of each query and the fastest of repeat timings, in ms
+    results, times = [], []
+    for query in queries:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = search_engine.search(query, k=k)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        results.append([result[0] for result in response[1]] if response else [])
+        times.append(best)
+    return results, times
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python eval_rerank.py <index dir> [queries file] [depths] [scorer] [k]")
+        sys.exit(1)
+
+    queries = DEFAULT_QUERIES
+    if len(sys.argv) > 2 and sys.argv[2] != '-':
+        with open(sys.argv[2], 'r') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    depths = [int(d) for d in sys.argv[3].split(',')] if len(sys.argv) > 3 else DEFAULT_DEPTHS
+    scorer = sys.argv[4] if len(sys.argv) > 4 else 'classic'
+    k = int(sys.argv[5]) if len(sys.argv) > 5 else 20
+
+    indexer = Indexer(None, None, None)
+    indexer.load_index(sys.argv[1])
+
+    def engine(rerank_depth):
+        # Every query must be ranked again, so no results are cached
+        return SearchEngine(indexer, None, result_cache_size=0, scorer=scorer, rerank_depth=rerank_depth)
+
+    # Maps the postings of every query term once before anything is timed
+    _run(engine(None), queries, k, repeat=1)
+    reference, reference_times = _run(engine(None), queries, k)
+
+    print(f'{len(queries)} queries, top {k}, scorer {scorer}')
+    print(f'{"depth":<12}{"overlap":>9}{"ndcg":>9}{"exact":>9}{"p50 ms":>10}{"p95 ms":>10}')
+    print(f'{"all":<12}{1:>9.3f}{1:>9.3f}{1:>9.3f}'
+          f'{_percentile(reference_times, 50):>10.2f}{_percentile(reference_times, 95):>10.2f}')
+    for depth in depths:
+        results, times = _run(engine(depth), queries, k)
+        overlap = np.mean([len(set(r) & set(ref)) / len(ref) if ref else 1.0
+                           for r, ref in zip(results, reference)])
+        ndcg = np.mean([_ndcg(r, ref) for r, ref in zip(results, reference)])
+        exact = np.mean([r == ref for r, ref in zip(results, reference)])
+        print(f'{depth:<12}{overlap:>9.3f}{ndcg:>9.3f}{exact:>9.3f}'
+              f'{_percentile(times, 50):>10.2f}{_percentile(times, 95):>10.2f}')
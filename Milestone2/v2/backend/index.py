@@ -1,162 +1,580 @@
 from token_utils import TokenUtils
+from postings import PostingList, DocTable, FIELDS, token_positions
+from disk_index import DiskIndex, IndexWriter, write_index, META_FILE
+from segments import (SegmentedIndex, IndexLock, TieredMergePolicy, is_segmented, load_manifest,
+                      migrate_index, new_segment_name, add_segment, merge_segments, commit, remove_segments,
+                      open_index)
+from shards import write_shards
+from pipeline import Pipeline, Stage
+from term_stats import TermStats, doc_totals
+from spimi import write_run, merge_runs, POSTING_BYTES, TERM_BYTES
 
+import hashlib
+import io
 import math
 import os
+import threading
+from array import array
 from collections import Counter
+from graphlib import TopologicalSorter
+from itertools import islice
+from multiprocessing import Pool
 
+import numpy as np
 from lxml import html
-from json import load as jload, dump as jdump
+from json import load as jload
 
 
-class Posting():
+# Fields whose terms mark a posting as tag important, and whose term frequencies are
+# stored per posting (postings.FIELDS)
+IMPORTANT_FIELDS = {
+    'title': ('title',),
+    'heading': ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'),
+    'bold': ('b',),
+}
+IMPORTANT_TAGS = {tag: field for field, tags in IMPORTANT_FIELDS.items() for tag in tags}
+# Worker threads of the ingestion stages before the postings accumulator
+STAGE_WORKERS = {'read': 2, 'parse': 2, 'tokenize': 1}
 
-    def __init__(self, loc, token, url, title, frequency, idx_list, tag_important=False, tfidf = 0):
-        self.loc = loc
-        self.token = token
-        self.url = url
-        self.title = title
-        self.frequency = frequency
-        self.idx_list = idx_list
-        self.tag_important = tag_important
-        self.tfidf = tfidf
+_worker = None
 
-    def __repr__(self):
-        return f'URL: {self.url}, count: {self.frequency}, tf-idf: {self.tfidf}'
 
-    def set_tfidf(self, tfidf):
-        self.tfidf = tfidf
- 
+def _init_worker(pages_path, batch_size):
+    # One Indexer (and one spaCy model) per build process
+    global _worker
+    _worker = Indexer(pages_path, None, None, batch_size=batch_size)
+
+
+class IndexSnapshot():
+
+    # One generation of a loaded or built index. Searches read the index, doc table
+    # and statistics through the snapshot they started with, and a reload swaps the
+    # whole snapshot at once, so a search never mixes two generations.
+    def __init__(self, inverted_index, docs, stats, version):
+        self.inverted_index = inverted_index
+        self.docs = docs
+        self.stats = stats
+        self.version = version
+
+
+def _build_shard(urls):
+    _worker.inverted_index = {}
+    _worker.docs = DocTable()
+    _worker._initialize_ii(urls)
+    return _worker.inverted_index, _worker.docs
+
 
 class Indexer():
 
-    def __init__(self, pages_path, ii_path, logs_path) -> None:
+    def __init__(self, pages_path, ii_path, logs_path, doc_limit=None, batch_size=64, n_process=1,
+                 stage_workers=None, queue_size=256) -> None:
         self.pages_path = pages_path
         self.ii_path = ii_path
         self.logs_path = logs_path
+        # Only index the first doc_limit bookkeeping entries (for quick test builds)
+        self.doc_limit = doc_limit
+        # Pages are tokenized batch_size at a time with nlp.pipe over n_process processes
+        self.batch_size = batch_size
+        self.n_process = n_process
+        # Ingestion pipeline: workers per stage and pages held by each queue between stages
+        self.stage_workers = dict(STAGE_WORKERS, **(stage_workers or {}))
+        self.queue_size = queue_size
+        self.pipeline_stats = None
 
         self.inverted_index = {}
+        self.docs = DocTable()
         self.num_unique_words = 0
         self.num_documents = 0
+        # Term statistics that query time idfs are computed from
+        self.stats = None
+        # Bumped whenever a new index is built or loaded, so searches can drop cached state
+        self.version = 0
+        # What searches read: the last index built or loaded
+        self.snapshot = IndexSnapshot(self.inverted_index, self.docs, None, self.version)
+        # Decoded postings cache of a loaded index, kept when it is reopened
+        self.postings_cache_bytes = 0
+        self.refresh_lock = threading.Lock()
+        # spaCy model, only loaded by the build paths that tokenize pages
+        self._utils = None
 
-        self.utils = TokenUtils()
-    
 
-    def _get_content(self, loc):
-        loc = loc.replace('/', '\\')
-        path = os.path.join(self.pages_path, loc)
-        tree = html.parse(path)
-        root = tree.getroot()
-        text = str(root.text_content()) if root is not None else None
+    @property
+    def utils(self):
+        if self._utils is None:
+            self._utils = TokenUtils()
+        return self._utils
 
-        return text, root
-    
 
-    def _initialize_ii(self, urls):
-        i = 0
+    def _page_path(self, loc):
+        return os.path.join(self.pages_path, loc.replace('/', '\\'))
+
+
+    def _page_digest(self, loc):
+        with open(self._page_path(loc), 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+
+    def _pages(self, urls):
         for loc, url in urls.items():
             if '#' in url:
                 continue
             print("Processing", loc)
-            text, root = self._get_content(loc)
-            if not text:
-                continue
-            tokens = self.utils.tokenize(text)
-            token_dict = Counter(tokens)
-
-            def _extend_tokens_to_ii(token_dict):
-                for token, count in token_dict.items():
-                    frequency = count / len(tokens)
-                    idx_list = [i for i in range(len(tokens)) if tokens[i] == token]
-                    tag_important = self._contains_important_token(root, token)
-                    # title = root.find(".//title").text if root.find(".//title") else "N/A"
-                    title_elem = root.xpath("//title")
-                    title = title_elem[0].text if title_elem else "N/A"
-                    posting = Posting(loc, token, url, title, frequency, idx_list, tag_important)
-                    if token not in self.inverted_index:
-                        self.inverted_index[token] = [posting]
-                    else:
-                        self.inverted_index[token].append(posting)
-
-            _extend_tokens_to_ii(token_dict)
-            if i == 100:
-                break
-            i += 1
+            yield loc, url
+
+
+    def _read_pages(self, pages):
+        contents = []
+        for loc, url in pages:
+            with open(self._page_path(loc), 'rb') as f:
+                contents.append((loc, url, f.read()))
+        return contents
+
+
+    def _parse_pages(self, contents):
+        # Pages without text are dropped
+        parsed = []
+        for loc, url, content in contents:
+            root = html.parse(io.BytesIO(content)).getroot()
+            text = str(root.text_content()) if root is not None else None
+            parsed.append((loc, url, root, text, self._important_texts(root)) if text else None)
+        return parsed
+
+
+    def _tokenize_pages(self, utils, parsed):
+        # Bodies and important-tag fields of the whole batch go through one nlp.pipe call
+        texts = []
+        for _, _, _, text, fields in parsed:
+            texts.append(text)
+            texts.extend(fields.values())
+
+        token_lists = iter(utils.tokenize_many(texts, n_process=self.n_process))
+        pages = []
+        for loc, url, root, _, _ in parsed:
+            tokens = next(token_lists)
+            fields = {field: Counter(next(token_lists)) for field in IMPORTANT_FIELDS}
+            pages.append((loc, url, root, tokens, fields))
+        return pages
+
+
+    def _stream(self, urls, accumulate):
+        # Streams the pages through bounded queues: file reads, HTML parsing and
+        # batched tokenization run in their own worker threads, so reads and parsing
+        # overlap with tokenizing, and accumulate gets every tokenized page in
+        # bookkeeping order on this thread. Extra tokenizer workers load their own model.
+        workers = {stage: max(1, n) for stage, n in self.stage_workers.items()}
+        pipeline = Pipeline([Stage('read', self._read_pages, workers['read']),
+                             Stage('parse', self._parse_pages, workers['parse']),
+                             Stage('tokenize', self._tokenize_pages, workers['tokenize'], self.batch_size,
+                                   init=lambda i: self.utils if i == 0 else TokenUtils())],
+                            self.queue_size)
+        pipeline.run(self._pages(urls), lambda page: accumulate(self._add_document(*page)))
+        self.pipeline_stats = pipeline.stats()
+        pipeline.print_stats()
+
+
+    def _initialize_ii(self, urls):
+        self._stream(urls, lambda doc_id: None)
+
+
+    def _initialize_ii_parallel(self, urls, workers):
+        # Contiguous shards keep doc ids in bookkeeping order, so the merged index
+        # is identical to a serial build
+        items = list(urls.items())
+        num_shards = min(len(items), workers * 4) or 1
+        shard_size = -(-len(items) // num_shards)
+        shards = [dict(items[i:i + shard_size]) for i in range(0, len(items), shard_size)]
+
+        with Pool(workers, initializer=_init_worker, initargs=(self.pages_path, self.batch_size)) as pool:
+            for inverted_index, docs in pool.imap(_build_shard, shards):
+                self._merge_shard(inverted_index, docs)
+
+
+    def _merge_shard(self, inverted_index, docs):
+        doc_offset = len(self.docs)
+        self.docs.extend(docs)
+        for token, postings in inverted_index.items():
+            if token not in self.inverted_index:
+                self.inverted_index[token] = PostingList()
+            self.inverted_index[token].extend(postings, doc_offset)
+
+
+    def _add_document(self, loc, url, root, tokens, fields):
+        token_dict = token_positions(tokens)
+        # title = root.find(".//title").text if root.find(".//title") else "N/A"
+        title_elem = root.xpath("//title")
+        title = title_elem[0].text if title_elem else "N/A"
+        field_counters = [fields[field] for field in FIELDS]
+        doc_id = self.docs.add(loc, url, title, len(tokens),
+                               [sum(counter.values()) for counter in field_counters])
+        important_tokens = set().union(*fields.values())
+
+        def _extend_tokens_to_ii(token_dict):
+            for token, idx_list in token_dict.items():
+                tag_important = token in important_tokens
+                if token not in self.inverted_index:
+                    self.inverted_index[token] = PostingList()
+                # Only tag important terms occur in any field
+                field_counts = [counter[token] for counter in field_counters] if tag_important else None
+                self.inverted_index[token].append(doc_id, len(idx_list), idx_list, tag_important,
+                                                  field_counts=field_counts)
+
+        _extend_tokens_to_ii(token_dict)
+        return doc_id
 
     
-    def _contains_important_token(self, root, token):
-        tags = ['title', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'b']
-        upper_alpha = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        lower_alpha = "abcdefghijklmnopqrstuvwxyz"
-        xpath_query = " | ".join([f".//{tag}[contains(translate(text(), '{upper_alpha}', '{lower_alpha}'), translate('{token}', '{upper_alpha}', '{lower_alpha}'))]" for tag in tags])
-        try:
-            elements = root.xpath(xpath_query)
-            return len(elements) > 0
-        except:
-            return False
+    def _important_texts(self, root):
+        # One walk over the important tags; each field's text is then tokenized like
+        # the body so matching is on lemmatized terms
+        texts = {field: [] for field in IMPORTANT_FIELDS}
+        for elem in root.iter(*IMPORTANT_TAGS):
+            texts[IMPORTANT_TAGS[elem.tag]].append(elem.text_content())
+
+        return {field: ' '.join(parts) for field, parts in texts.items()}
+
+
+    def _add_squares(self, postings, lengths, squares):
+        # Adds each posting's squared tf-idf to its document's squared vector length.
+        # Postings only store counts: tf-idfs are computed here for the norms and at
+        # query time for scores.
+        doc_ids = np.frombuffer(postings.doc_ids, dtype=np.uint32)
+        tf = np.frombuffer(postings.counts, dtype=np.uint32) / lengths[doc_ids]
+        squares[doc_ids] += (tf * math.log(self.num_documents / len(doc_ids))) ** 2
 
 
     def _update_ii(self):
-        for postings in self.inverted_index.values():
-            dft = len(postings)
-            idf = math.log(self.num_documents/ dft)
-            for posting in postings:
-                tf = posting.frequency
-                tfidf = tf * idf
-                posting.set_tfidf(tfidf)
+        # Squares are summed in term byte order, the order SPIMI merges and the first
+        # commit of a segmented index read terms in, so every full build path writes
+        # bit-identical norms
+        lengths = np.frombuffer(self.docs.lengths, dtype=np.uint32)
+        squares = np.zeros(len(self.docs))
+        for token in sorted(self.inverted_index, key=lambda t: t.encode('utf-8')):
+            self._add_squares(self.inverted_index[token], lengths, squares)
+        self.docs.norms = array('d', np.sqrt(squares).tobytes())
+        self.stats = self._memory_stats()
+        self._publish()
+
+
+    def _publish(self):
+        self.version += 1
+        self.snapshot = IndexSnapshot(self.inverted_index, self.docs, self.stats, self.version)
 
 
-    def construct_index(self):
+    def _memory_stats(self):
+        def _doc_freq(token):
+            postings = self.inverted_index.get(token)
+            return len(postings) if postings is not None else 0
+        return TermStats(self.num_documents, *doc_totals(self.docs), _doc_freq)
+
+
+    def _load_bookkeeping(self):
         bk_path = os.path.join(self.pages_path, 'bookkeeping.json')
         with open(bk_path, 'r') as f:
             urls = jload(f)
             
         self.num_documents = len(urls)
-        self._initialize_ii(urls)
+        if self.doc_limit is not None:
+            urls = dict(islice(urls.items(), self.doc_limit))
+        return urls
+
+
+    def construct_index(self, workers=1):
+        urls = self._load_bookkeeping()
+        if workers > 1:
+            self._initialize_ii_parallel(urls, workers)
+        else:
+            self._initialize_ii(urls)
         self._update_ii()
         self.num_unique_words = len(self.inverted_index)
         
         return self.inverted_index
 
 
+    def construct_shards(self, index_dir, num_shards, workers=1):
+        # Splits bookkeeping.json into num_shards contiguous slices, each indexed on its
+        # own into index_dir/shard_<i> and served by its own process
+        items = list(self._load_bookkeeping().items())
+        shard_size = -(-len(items) // num_shards) or 1
+        names = []
+        for i, start in enumerate(range(0, len(items), shard_size)):
+            self.inverted_index = {}
+            self.docs = DocTable()
+            urls = dict(items[start:start + shard_size])
+            if workers > 1:
+                self._initialize_ii_parallel(urls, workers)
+            else:
+                self._initialize_ii(urls)
+            self._update_ii()
+            names.append(f'shard_{i}')
+            write_index(os.path.join(index_dir, names[-1]), self.inverted_index, self.docs, self.num_documents)
+        with IndexLock(index_dir):
+            write_shards(index_dir, names, self.num_documents)
+            remove_segments(index_dir)
+
+
+    def construct_index_spimi(self, index_dir, memory_budget, impact_ordered=False):
+        # Like save_index, holds the write lock so that a segmented index in index_dir
+        # is replaced without a merge committing over the files being written
+        with IndexLock(index_dir):
+            self._build_spimi(index_dir, memory_budget, impact_ordered)
+            remove_segments(index_dir)
+        self.load_index(index_dir)
+
+
+    def _build_spimi(self, index_dir, memory_budget, impact_ordered):
+        # Single-pass in-memory indexing: postings are flushed to sorted runs whenever
+        # the estimated size of the in-memory index reaches memory_budget bytes, then
+        # the runs are k-way merged straight into the on-disk index
+        urls = self._load_bookkeeping()
+        run_dir = os.path.join(index_dir, 'runs')
+        os.makedirs(run_dir, exist_ok=True)
+        writer = IndexWriter(index_dir)
+        lengths = array('I')
+        runs = []
+
+        def _flush():
+            base = writer.num_docs
+            for doc_id in range(len(self.docs)):
+                loc, url, title = self.docs[doc_id]
+                writer.add_document(loc, url, title, self.docs.length(doc_id), self.docs.field_length(doc_id))
+            lengths.extend(self.docs.lengths)
+            for postings in self.inverted_index.values():
+                postings.doc_ids = array('I', (doc_id + base for doc_id in postings.doc_ids))
+
+            path = os.path.join(run_dir, f'run{len(runs)}.bin')
+            write_run(path, self.inverted_index)
+            runs.append(path)
+            self.inverted_index = {}
+            self.docs = DocTable()
+
+        used = 0
+        num_terms = 0
+
+        def _accumulate(doc_id):
+            nonlocal used, num_terms
+            used += self.docs.length(doc_id) * POSTING_BYTES
+            used += (len(self.inverted_index) - num_terms) * TERM_BYTES
+            num_terms = len(self.inverted_index)
+            if used >= memory_budget:
+                _flush()
+                used = num_terms = 0
+
+        self._stream(urls, _accumulate)
+        if len(self.docs):
+            _flush()
+
+        # Impact ordering needs every document's final norm before the first term is
+        # written, which costs one extra merge pass over the runs
+        lengths = np.frombuffer(lengths, dtype=np.uint32)
+        squares = np.zeros(len(lengths))
+        if impact_ordered:
+            for token, postings in merge_runs(runs):
+                self._add_squares(postings, lengths, squares)
+            writer.impact_norms = array('d', np.sqrt(squares).tobytes())
+
+        for token, postings in merge_runs(runs):
+            if not impact_ordered:
+                self._add_squares(postings, lengths, squares)
+            writer.add_term(token, postings)
+        writer.close(self.num_documents, array('d', np.sqrt(squares).tobytes()))
+
+        for path in runs:
+            os.remove(path)
+        os.rmdir(run_dir)
+
+
     def load_table(self):
+        # Reads the legacy table.json format into compact postings
         with open(self.ii_path, 'r') as f:
             table = jload(f)
-            self.num_unique_words = table['unique_words']
-            self.num_documents = table['num_documents']
-            ii = table['inverted_index']
-            for index, postings in ii.items():
-                self.inverted_index[index] = []
-                for posting in postings:
-                    self.inverted_index[index].append(Posting(posting['loc'],
-                                                              posting['token'],
-                                                              posting['url'],
-                                                              posting['title'],
-                                                              posting['frequency'],
-                                                              posting['idx_list'],
-                                                              posting['tag_important'],
-                                                              posting['tfidf'])
-                                                              )
-
-
-    def save_table(self):
-        with open(self.ii_path, 'w') as f:
-            table = {}
-            table['unique_words'] = self.num_unique_words
-            table['num_documents'] = self.num_documents
-            table['inverted_index'] = self.inverted_index
-            jdump(table, f, default=lambda o: o.__dict__)
+        self.num_unique_words = table['unique_words']
+        self.num_documents = table['num_documents']
+        ii = table['inverted_index']
+
+        # Each postings list is in crawl order, so ordering the documents consistently
+        # with every list recovers the order they were indexed in
+        sorter = TopologicalSorter()
+        docs = {}
+        for postings in ii.values():
+            prev = None
+            for posting in postings:
+                docs.setdefault(posting['loc'], posting)
+                if prev is None:
+                    sorter.add(posting['loc'])
+                else:
+                    sorter.add(posting['loc'], prev)
+                prev = posting['loc']
+
+        doc_ids = {}
+        for loc in sorter.static_order():
+            posting = docs[loc]
+            length = round(len(posting['idx_list']) / posting['frequency'])
+            doc_ids[loc] = self.docs.add(loc, posting['url'], posting['title'], length)
+
+        for token, postings in ii.items():
+            self.inverted_index[token] = PostingList()
+            for posting in sorted(postings, key=lambda p: doc_ids[p['loc']]):
+                self.inverted_index[token].append(doc_ids[posting['loc']],
+                                                  len(posting['idx_list']),
+                                                  posting['idx_list'],
+                                                  posting['tag_important'])
+
+        # The table's tf-idfs are dropped; norms are computed from counts like a build's
+        self._update_ii()
+
+
+    def update_index(self, index_dir, merge_policy=None):
+        # Re-indexes only the pages added, changed or removed in bookkeeping.json since
+        # the last build or update: new and changed pages go into a delta segment, the
+        # documents they replace are tombstoned, and idf and norms are updated for the
+        # terms of the added and removed documents. merge_policy (tiered by default)
+        # then compacts segments.
+        with IndexLock(index_dir):
+            if not is_segmented(index_dir):
+                self._migrate_index(index_dir)
+            self._add_delta_segment(index_dir)
+        (merge_policy or TieredMergePolicy()).merge(index_dir)
+        self.load_index(index_dir)
+
+
+    def _migrate_index(self, index_dir):
+        # A plain index stores no page digests: pages modified after it was built
+        # get none, so they count as changed. Servers reading the plain index keep
+        # reading it until they see the segments.
+        index = DiskIndex(index_dir)
+        built = os.path.getmtime(os.path.join(index_dir, META_FILE))
+        pages = {}
+        for doc_id in range(len(index.docs)):
+            loc, url, _ = index.docs[doc_id]
+            unchanged = os.path.getmtime(self._page_path(loc)) <= built
+            pages[loc] = [doc_id, url, self._page_digest(loc) if unchanged else None]
+        del index
+        migrate_index(index_dir, pages)
+
+
+    def _add_delta_segment(self, index_dir):
+        manifest, pages = load_manifest(index_dir)
+        urls = {loc: url for loc, url in self._load_bookkeeping().items() if '#' not in url}
+        changed = {}
+        digests = {}
+        for loc, url in urls.items():
+            digest = self._page_digest(loc)
+            if loc not in pages or pages[loc][1:] != [url, digest]:
+                changed[loc] = url
+                digests[loc] = digest
+        stale = [loc for loc in pages if loc not in urls or loc in changed]
+        deleted = [pages[loc][0] for loc in stale if pages[loc][0] is not None]
+        for loc in stale:
+            del pages[loc]
+        if not changed and not deleted and manifest['num_documents'] == self.num_documents:
+            return
+
+        name = None
+        if changed:
+            self.inverted_index = {}
+            self.docs = DocTable()
+            self._initialize_ii(changed)
+            if len(self.docs):
+                self._update_ii()
+                name = new_segment_name(manifest)
+                write_index(os.path.join(index_dir, name), self.inverted_index, self.docs, self.num_documents)
+        base = sum(segment['num_docs'] for segment in manifest['segments'])
+        for loc, url in changed.items():
+            pages[loc] = [None, url, digests[loc]]
+        if name is not None:
+            for doc_id in range(len(self.docs)):
+                pages[self.docs[doc_id][0]][0] = base + doc_id
+        manifest = add_segment(manifest, name, len(self.docs) if name else 0, deleted, self.num_documents)
+        commit(index_dir, manifest, pages)
+
+
+    def compact_index(self, index_dir):
+        # Merges every segment into one in bookkeeping order, the doc order a full
+        # rebuild would give
+        urls = [loc for loc, url in self._load_bookkeeping().items() if '#' not in url]
+        with IndexLock(index_dir):
+            manifest, pages = load_manifest(index_dir)
+            order = {pages[loc][0]: i for i, loc in enumerate(urls) if loc in pages and pages[loc][0] is not None}
+            manifest, pages = merge_segments(index_dir, manifest, pages, 0, len(manifest['segments']),
+                                             order.__getitem__)
+            commit(index_dir, manifest, pages)
+        self.load_index(index_dir)
+
+
+    def load_index(self, index_dir, postings_cache_bytes=None):
+        if postings_cache_bytes is not None:
+            self.postings_cache_bytes = postings_cache_bytes
+        inverted_index = open_index(index_dir, self.postings_cache_bytes)
+        self.inverted_index = inverted_index
+        self.docs = inverted_index.docs
+        self.num_unique_words = inverted_index.meta['unique_words']
+        self.num_documents = inverted_index.meta['num_documents']
+        if isinstance(inverted_index, SegmentedIndex):
+            self.stats = inverted_index.stats
+        else:
+            self.stats = TermStats(self.num_documents, *doc_totals(self.docs), inverted_index.doc_freq)
+        self._publish()
+
+
+    def _is_stale(self, index):
+        # A segmented index is stale once an update or a background merge has committed
+        # new segments; a plain one once the first update has turned it into segments
+        if isinstance(index, SegmentedIndex):
+            return index.is_stale()
+        return isinstance(index, DiskIndex) and is_segmented(index.index_dir)
+
+
+    def refresh_index(self):
+        # Reopens the index once it is stale. Searches already running keep the
+        # snapshot they started with.
+        index = self.snapshot.inverted_index
+        if self._is_stale(index):
+            with self.refresh_lock:
+                if self.snapshot.inverted_index is index:
+                    self.load_index(index.index_dir)
+
+
+    def save_index(self, index_dir, impact_ordered=False):
+        # A full rebuild replaces a segmented index in index_dir. The write lock keeps
+        # updates and background merges from committing while it is written.
+        with IndexLock(index_dir):
+            write_index(index_dir, self.inverted_index, self.docs, self.num_documents, impact_ordered)
+            remove_segments(index_dir)
+
+
+    def get_postings(self, token):
+        return self.inverted_index.get(token)
+
+
+    def warm_postings(self, token_uses):
+        # Only an on-disk index has a postings cache to fill
+        index = self.snapshot.inverted_index
+        if isinstance(index, (DiskIndex, SegmentedIndex)):
+            return index.warm(token_uses)
+        return 0
+
+
+    def doc_freq(self, token):
+        return self.stats.doc_freq(token) or 0
 
 
     def print_ii(self):
         for token, postings in sorted(self.inverted_index.items(), key=lambda x: len(x[1])):
             print(f'TOKEN: {token}')
-            for posting in postings:
-                print(f'POSTING: {posting}')
+            for i, doc_id in enumerate(postings.doc_ids):
+                frequency = postings.counts[i] / self.docs.length(doc_id)
+                tfidf = frequency * math.log(self.num_documents / len(postings))
+                print(f'POSTING: URL: {self.docs[doc_id][1]}, count: {frequency}, tf-idf: {tfidf}')
             print()
 
 
+    def _index_size(self):
+        if isinstance(self.inverted_index, (DiskIndex, SegmentedIndex)):
+            return self.inverted_index.size()
+        return os.path.getsize(self.ii_path)
+
+
     def save_analytics(self):
-        file_size = os.path.getsize(self.ii_path)
+        file_size = self._index_size()
         with open(self.logs_path, 'w') as f:
             f.write('Index Analytics Table:\n')
             f.write(f'\tNumber of unique words: {self.num_unique_words}\n')
@@ -166,7 +584,7 @@ class Indexer():
 
 
     def print_analytics(self):
-        file_size = os.path.getsize(self.ii_path)
+        file_size = self._index_size()
         print('Index Analytics Table:')
         print(f'\tNumber of unique words: {self.num_unique_words}')
         print(f'\tNumber of documents: {self.num_documents}')
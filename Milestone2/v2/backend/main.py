@@ -1,11 +1,74 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from search import SearchEngine
+from pydantic import BaseModel, Field
+from typing import Literal
 from index import Indexer
+from search_pool import SearchPool, ShardedSearchPool
+from shards import is_sharded
+from segments import BackgroundMerger
 import os
+import uvicorn
 
-app = FastAPI()
+PAGES_PATH = r"..\..\..\WEBPAGES_RAW"
+II_PATH = r"..\..\table.json"
+INDEX_DIR = r"..\..\index"
+LOGS_PATH = r"..\..\logs.txt"
+# Served queries, read back at startup to warm up the postings caches
+QUERY_LOG_PATH = r"..\..\queries.txt"
+
+# Serving: HTTP worker processes, and per worker the size and kind of the scoring pool
+HTTP_WORKERS = int(os.environ.get("SEARCH_HTTP_WORKERS", 1))
+POOL_WORKERS = int(os.environ.get("SEARCH_POOL_WORKERS", 4))
+POOL_PROCESSES = os.environ.get("SEARCH_POOL_PROCESSES", "0") == "1"
+# Decoded postings of hot terms kept per scoring process
+POSTINGS_CACHE_MB = int(os.environ.get("SEARCH_POSTINGS_CACHE_MB", 256))
+# Seconds between background merge checks of a segmented index (0 turns them off)
+MERGE_INTERVAL = int(os.environ.get("SEARCH_MERGE_INTERVAL", 30))
+# Ranking model, a name in scorers.SCORERS ('classic' or 'bm25f')
+SCORER = os.environ.get("SEARCH_SCORER", "classic")
+# Candidates per query that get the scorer's expensive second stage, picked by its
+# cheap first stage (0 gives every candidate both stages)
+RERANK_DEPTH = int(os.environ.get("SEARCH_RERANK_DEPTH", 0)) or None
+
+
+def prepare_index():
+    # Builds the index once, before any worker process maps it
+    if not os.path.isdir(INDEX_DIR):
+        indexer = Indexer(PAGES_PATH, II_PATH, LOGS_PATH)
+        if os.path.isfile(II_PATH):
+            indexer.load_table()
+        else:
+            indexer.construct_index()
+        indexer.save_index(INDEX_DIR)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Each worker maps the index after it has started, so no index state is
+    # inherited across a fork; the mapping is read only and shared through the page cache
+    prepare_index()
+    if is_sharded(INDEX_DIR):
+        # Built with build_index.py --shards: one process per shard, queries fan out to all
+        app.state.search_pool = ShardedSearchPool(INDEX_DIR, QUERY_LOG_PATH,
+                                                  postings_cache_bytes=POSTINGS_CACHE_MB * 1024 * 1024,
+                                                  scorer=SCORER, rerank_depth=RERANK_DEPTH)
+    else:
+        app.state.search_pool = SearchPool(INDEX_DIR, QUERY_LOG_PATH, POOL_WORKERS, POOL_PROCESSES,
+                                           postings_cache_bytes=POSTINGS_CACHE_MB * 1024 * 1024,
+                                           scorer=SCORER, rerank_depth=RERANK_DEPTH)
+    # Segments added by build_index.py --update are compacted while searches keep
+    # running; searches switch to the merged segments once they are committed
+    merger = BackgroundMerger(INDEX_DIR, interval=MERGE_INTERVAL) if MERGE_INTERVAL > 0 else None
+    if merger:
+        merger.start()
+    yield
+    if merger:
+        merger.stop()
+    app.state.search_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -15,36 +78,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-PAGES_PATH = r"..\..\..\WEBPAGES_RAW"
-II_PATH = r"..\..\table.json"
-LOGS_PATH = r"..\..\logs.txt"
-
-# Initialize the search engine
-indexer = Indexer(PAGES_PATH, II_PATH, LOGS_PATH)
-if os.path.isfile(II_PATH):
-        indexer.load_table()
-else:
-    inverted_index = indexer.construct_index()
-    indexer.save_table()
-            
-search_engine = SearchEngine(indexer, LOGS_PATH)
-
 class QueryRequest(BaseModel):
     query: str
+    k: int = Field(20, gt=0, le=1000)
+    retrieval: Literal['all', 'wand', 'impact', 'and', 'phrase'] = 'all'
 
 @app.post("/search")
-def search(query_request: QueryRequest):
+async def search(query_request: QueryRequest):
     query = query_request.query
-    response = search_engine.search(query)
+    response = await app.state.search_pool.search(query, k=query_request.k, retrieval=query_request.retrieval)
     if response:
         numUrls, searchResults = response
     else:
         return None
     searchResults = [(title, url) for url, title, _, _ in searchResults]
     return searchResults
-    
+
+
+class BatchQueryRequest(BaseModel):
+    queries: list[str] = Field(..., min_length=1, max_length=10000)
+    k: int = Field(20, gt=0, le=1000)
+    retrieval: Literal['all', 'wand', 'impact', 'and', 'phrase'] = 'all'
+
+@app.post("/search/batch")
+async def search_batch(batch_request: BatchQueryRequest):
+    # One result list per query, in request order (None when nothing matched)
+    responses = await app.state.search_pool.search_many(batch_request.queries, k=batch_request.k,
+                                                        retrieval=batch_request.retrieval)
+    return [[(title, url) for url, title, _, _ in response[1]] if response else None
+            for response in responses]
+
+
+@app.get("/search/stats")
+async def search_stats():
+    return await app.state.search_pool.cache_stats()
+
 
 @app.options("/search")
 def options_search(response: Response):
     response.headers["Allow"] = "POST, OPTIONS"
-    return response
\ No newline at end of file
+    return response
+
+
+if __name__ == "__main__":
+    prepare_index()
+    uvicorn.run("main:app", workers=HTTP_WORKERS)
@@ -0,0 +1,225 @@
+import queue
+import threading
+import time
+
+
+# Passed down a queue after the last item
+DONE = object()
+
+
+class Channel():
+
+    # Bounded queue between two stages, recording how full it gets
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.maxsize = maxsize
+        self.puts = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        # Returns the seconds spent waiting for room
+        start = time.perf_counter()
+        self.queue.put(item)
+        waited = time.perf_counter() - start
+        depth = self.queue.qsize()
+        self.puts += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+        return waited
+
+    def get(self):
+        # Returns the item and the seconds spent waiting for it
+        start = time.perf_counter()
+        item = self.queue.get()
+        return item, time.perf_counter() - start
+
+
+class Stage():
+
+    def __init__(self, name, fn, workers=1, batch_size=1, init=None):
+        # fn maps a list of items to the list of their results, None dropping an item.
+        # init(i), if given, makes the i-th worker's own state, passed as fn's first argument.
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.init = init
+
+        self.lock = threading.Lock()
+        self.items = 0
+        # Seconds summed over the workers: running fn, waiting for input (the stage
+        # is starved) and waiting for room downstream (the stage is backpressured)
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.running = 0
+
+
+    def _count(self, items=0, busy=0.0, starved=0.0, blocked=0.0):
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+
+
+    def _take(self, inbox):
+        # Up to batch_size (sequence number, item) pairs, and whether DONE was reached
+        batch = []
+        while len(batch) < self.batch_size:
+            item, waited = inbox.get()
+            self._count(starved=waited)
+            if item is DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+
+    def _work(self, i, inbox, outbox, pipeline):
+        state = None
+        try:
+            if self.init is not None:
+                state = self.init(i)
+        except Exception as e:
+            # The worker still drains its inbox below, so no stage before it blocks
+            pipeline.fail(e)
+        try:
+            done = False
+            while not done:
+                batch, done = self._take(inbox)
+                live = [(seq, item) for seq, item in batch if item is not None]
+                results = {}
+                if live and pipeline.error is None:
+                    start = time.perf_counter()
+                    try:
+                        items = [item for _, item in live]
+                        outputs = self.fn(state, items) if self.init is not None else self.fn(items)
+                        results = dict(zip([seq for seq, _ in live], outputs))
+                    except Exception as e:
+                        pipeline.fail(e)
+                    self._count(len(live), busy=time.perf_counter() - start)
+                if pipeline.error is None:
+                    # Dropped items still go down as None, so the sink can keep its order
+                    for seq, _ in batch:
+                        self._count(blocked=outbox.put((seq, results.get(seq))))
+        except Exception as e:
+            pipeline.fail(e)
+        finally:
+            # Lets the other workers see DONE too; the last one passes it on
+            inbox.queue.put(DONE)
+            with self.lock:
+                self.running -= 1
+                last = self.running == 0
+            if last:
+                outbox.put(DONE)
+
+
+class Pipeline():
+
+    # Stages run in threads connected by bounded channels; a full channel blocks the
+    # stage feeding it, so a slow stage holds back the ones before it instead of
+    # letting work pile up in memory
+    def __init__(self, stages, queue_size=256):
+        self.stages = stages
+        self.channels = [Channel(queue_size) for _ in range(len(stages) + 1)]
+        self.error = None
+        self.error_lock = threading.Lock()
+        self.elapsed = 0.0
+        self.sink_items = 0
+        self.sink_busy = 0.0
+        self.sink_starved = 0.0
+
+
+    def fail(self, error):
+        with self.error_lock:
+            if self.error is None:
+                self.error = error
+
+
+    def _feed(self, source):
+        for seq, item in enumerate(source):
+            if self.error is not None:
+                break
+            self.channels[0].put((seq, item))
+        self.channels[0].put(DONE)
+
+
+    def run(self, source, sink):
+        # Calls sink with the results of the last stage in the order of source, on the
+        # calling thread; raises the first error of any stage once all threads stopped
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, args=(source,), daemon=True)]
+        for s, stage in enumerate(self.stages):
+            stage.running = stage.workers
+            for i in range(stage.workers):
+                threads.append(threading.Thread(target=stage._work, daemon=True,
+                                                args=(i, self.channels[s], self.channels[s + 1], self)))
+        for thread in threads:
+            thread.start()
+
+        pending = {}
+        next_seq = 0
+        while True:
+            item, waited = self.channels[-1].get()
+            self.sink_starved += waited
+            if item is DONE:
+                break
+            seq, result = item
+            pending[seq] = result
+            while next_seq in pending:
+                result = pending.pop(next_seq)
+                next_seq += 1
+                if result is None or self.error is not None:
+                    continue
+                sink_start = time.perf_counter()
+                try:
+                    sink(result)
+                    self.sink_items += 1
+                except Exception as e:
+                    self.fail(e)
+                self.sink_busy += time.perf_counter() - sink_start
+
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+        if self.error is not None:
+            raise self.error
+
+
+    def stats(self, sink_name='accumulate'):
+        # Per stage: items per second of wall time, how busy its workers were, and the
+        # time they waited on input or on a full output queue, plus that queue's depth
+        elapsed = self.elapsed or 1e-9
+        rows = []
+        for stage, channel in zip(self.stages, self.channels[1:]):
+            rows.append({'stage': stage.name,
+                         'workers': stage.workers,
+                         'items': stage.items,
+                         'items_per_s': stage.items / elapsed,
+                         'utilization': stage.busy / (elapsed * stage.workers),
+                         'starved_s': stage.starved,
+                         'blocked_s': stage.blocked,
+                         'queue_avg': channel.depth_sum / channel.puts if channel.puts else 0.0,
+                         'queue_max': channel.max_depth,
+                         'queue_size': channel.maxsize})
+        rows.append({'stage': sink_name,
+                     'workers': 1,
+                     'items': self.sink_items,
+                     'items_per_s': self.sink_items / elapsed,
+                     'utilization': self.sink_busy / elapsed,
+                     'starved_s': self.sink_starved,
+                     'blocked_s': 0.0,
+                     'queue_avg': 0.0,
+                     'queue_max': 0,
+                     'queue_size': 0})
+        return rows
+
+
+    def print_stats(self, sink_name='accumulate'):
+        print(f'Pipeline: {self.elapsed:.1f}s')
+        for row in self.stats(sink_name):
+            print(f"\t{row['stage']:<12} workers: {row['workers']:<3} items: {row['items']:<7} "
+                  f"{row['items_per_s']:8.1f}/s  busy: {row['utilization']:6.1%}  "
+                  f"starved: {row['starved_s']:7.1f}s  blocked: {row['blocked_s']:7.1f}s  "
+                  f"out queue: {row['queue_avg']:.1f} avg, {row['queue_max']}/{row['queue_size']} max")
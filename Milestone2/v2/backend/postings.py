@@ -0,0 +1,148 @@
+from array import array
+
+from codec import encode_gaps, decode_gaps
+
+
+# Fields with their own term frequencies and lengths, besides the whole document
+FIELDS = ('title', 'heading', 'bold')
+NO_FIELDS = array('B', bytes(len(FIELDS)))
+
+
+def token_positions(tokens):
+    # All position lists of a document in one pass, in first-occurrence order
+    positions = {}
+    for idx, token in enumerate(tokens):
+        if token in positions:
+            positions[token].append(idx)
+        else:
+            positions[token] = [idx]
+    return positions
+
+
+class PostingList():
+
+    def __init__(self):
+        # Parallel columns, one entry per document containing the term
+        self.doc_ids = array('I')
+        self.counts = array('I')
+        self.tags = array('B')
+        # term frequency in each of FIELDS, len(FIELDS) entries per posting (capped at
+        # 255, far past where a ranking function saturates)
+        self.fields = array('B')
+        # gap-encoded positions of the i-th posting are positions[offsets[i]:offsets[i+1]]
+        self.offsets = array('I', [0])
+        self.positions = bytearray()
+        # term frequencies and their upper bounds per window of doc ids, filled in on
+        # first use by query evaluation
+        self.tfs = None
+        self.block_windows = None
+        self.block_starts = None
+        self.block_max = None
+        # posting indices by decreasing normalized term frequency, stored or computed on
+        # first use
+        self.impacts = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __repr__(self):
+        return f'PostingList(df: {len(self)}, positions: {len(self.positions)} bytes)'
+
+    def append(self, doc_id, count, idx_list, tag_important=False, field_counts=None):
+        self.doc_ids.append(doc_id)
+        self.counts.append(count)
+        self.tags.append(int(tag_important))
+        if field_counts is None:
+            self.fields.extend(NO_FIELDS)
+        else:
+            self.fields.extend([min(count, 255) for count in field_counts])
+        encode_gaps(idx_list, self.positions)
+        self.offsets.append(len(self.positions))
+
+    def extend(self, other, doc_offset=0):
+        self.doc_ids.extend(doc_id + doc_offset for doc_id in other.doc_ids)
+        self.counts.extend(other.counts)
+        self.tags.extend(other.tags)
+        self.fields.extend(other.fields)
+        base = len(self.positions) - other.offsets[0]
+        self.offsets.extend(offset + base for offset in other.offsets[1:])
+        self.positions += other.positions[other.offsets[0]:other.offsets[-1]]
+
+    def select(self, indices, doc_ids):
+        # New list of the postings at indices, in that order, renumbered to doc_ids
+        selected = PostingList()
+        selected.doc_ids = array('I', doc_ids)
+        selected.counts = array('I', [self.counts[i] for i in indices])
+        selected.tags = array('B', [self.tags[i] for i in indices])
+        width = len(FIELDS)
+        for i in indices:
+            selected.fields.extend(self.fields[i * width:(i + 1) * width])
+        for i in indices:
+            selected.positions += self.positions[self.offsets[i]:self.offsets[i + 1]]
+            selected.offsets.append(len(selected.positions))
+        return selected
+
+    def nbytes(self):
+        # Memory held by the decoded columns, used to budget the postings cache
+        columns = [self.doc_ids, self.counts, self.tags, self.fields, self.offsets]
+        if self.impacts is not None:
+            columns.append(self.impacts)
+        return sum(len(column) * column.itemsize for column in columns) + len(self.positions)
+
+    def impact_order(self, norms, lengths):
+        # Impact of a posting is its term frequency over the document's vector norm, i.e.
+        # its share of the document's cosine score per unit of query weight and idf.
+        # The idf is the same for every posting of the term, so it does not change the order.
+        if self.impacts is None:
+            def _impact(i):
+                doc_id = self.doc_ids[i]
+                norm = norms[doc_id]
+                return self.counts[i] / lengths[doc_id] / norm if norm else 0.0
+            self.impacts = array('I', sorted(range(len(self)), key=lambda i: -_impact(i)))
+        return self.impacts
+
+    def idx_list(self, i):
+        # Positions are only decoded for the postings a query actually inspects
+        return decode_gaps(self.positions, self.offsets[i], self.counts[i])[0]
+
+
+class DocTable():
+
+    def __init__(self):
+        self.locs = []
+        self.urls = []
+        self.titles = []
+        self.lengths = array('I')
+        # length of each of FIELDS, len(FIELDS) entries per document
+        self.field_lengths = array('I')
+        # tf-idf vector norm over all terms of each document, set by the idf pass
+        self.norms = array('d')
+
+    def __len__(self):
+        return len(self.locs)
+
+    def __getitem__(self, doc_id):
+        return self.locs[doc_id], self.urls[doc_id], self.titles[doc_id]
+
+    def add(self, loc, url, title, length, field_lengths=None):
+        self.locs.append(loc)
+        self.urls.append(url)
+        self.titles.append(title)
+        self.lengths.append(length)
+        self.field_lengths.extend(field_lengths or [0] * len(FIELDS))
+
+        return len(self.locs) - 1
+
+    def extend(self, other):
+        self.locs.extend(other.locs)
+        self.urls.extend(other.urls)
+        self.titles.extend(other.titles)
+        self.lengths.extend(other.lengths)
+        self.field_lengths.extend(other.field_lengths)
+        self.norms.extend(other.norms)
+
+    def length(self, doc_id):
+        return self.lengths[doc_id]
+
+    def field_length(self, doc_id):
+        return self.field_lengths[doc_id * len(FIELDS):(doc_id + 1) * len(FIELDS)].tolist()
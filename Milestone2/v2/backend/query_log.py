@@ -0,0 +1,31 @@
+import os
+import threading
+from collections import Counter, deque
+
+
+class QueryLog():
+
+    # Served queries, one per line, appended by every search front end and read back
+    # to warm up postings caches. Unlike logs.txt, which builds rewrite with their
+    # analytics, nothing truncates it.
+    def __init__(self, path, max_lines=100000):
+        self.path = path
+        # Only the most recent max_lines queries are read back
+        self.max_lines = max_lines
+        self.lock = threading.Lock()
+
+    def append(self, queries):
+        # One write per call, so lines appended by several processes stay whole
+        lines = ''.join(' '.join(query.split()) + '\n' for query in queries if query.strip())
+        if not lines:
+            return
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    def most_common(self, n):
+        # (query, times searched) of the n most frequent recent queries
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            recent = deque((line.rstrip('\n') for line in f), self.max_lines)
+        return Counter(recent).most_common(n)
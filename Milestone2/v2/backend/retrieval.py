@@ -0,0 +1,200 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from functools import partial
+
+import numpy as np
+
+
+# Doc ids per window of block-max pruning
+WINDOW = 1024
+
+
+def gallop(values, target, lo=0):
+    # Index of the first value >= target at or after lo, probing 1, 2, 4, ... ahead
+    # before binary searching, so short skips stay cheap on long lists
+    n = len(values)
+    if lo >= n or values[lo] >= target:
+        return lo
+    step = 1
+    hi = lo + 1
+    while hi < n and values[hi] < target:
+        lo = hi
+        step *= 2
+        hi = lo + step
+    return bisect_left(values, target, lo + 1, min(hi, n))
+
+
+def intersect(doc_lists):
+    # Conjunctive merge driven by the shortest list: every other list is only probed
+    # by galloping forward from its last match, so the cost follows the short list.
+    # Returns the common doc ids and, per list, the index of each match in it.
+    # Lists that skip by blocks (disk_index.BlockDocIds) gallop by themselves
+    seeks = [getattr(doc_list, 'gallop', None) or partial(gallop, doc_list) for doc_list in doc_lists]
+    order = sorted(range(len(doc_lists)), key=lambda j: len(doc_lists[j]))
+    shortest = doc_lists[order[0]]
+    positions = [0] * len(doc_lists)
+    doc_ids = []
+    rows = [[] for _ in doc_lists]
+
+    for i, doc_id in enumerate(shortest):
+        positions[order[0]] = i
+        for j in order[1:]:
+            positions[j] = seeks[j](doc_id, positions[j])
+            if positions[j] >= len(doc_lists[j]):
+                return doc_ids, rows
+            if doc_lists[j][positions[j]] != doc_id:
+                break
+        else:
+            doc_ids.append(doc_id)
+            for j in range(len(doc_lists)):
+                rows[j].append(positions[j])
+    return doc_ids, rows
+
+
+def phrase_match(idx_lists):
+    # True when the i-th position list contains p + i for some start p, probing the
+    # later lists with galloping search
+    starts = idx_lists[0]
+    cursors = [0] * len(idx_lists)
+    for start in starts:
+        for i in range(1, len(idx_lists)):
+            cursors[i] = gallop(idx_lists[i], start + i, cursors[i])
+            if cursors[i] >= len(idx_lists[i]):
+                return False
+            if idx_lists[i][cursors[i]] != start + i:
+                break
+        else:
+            return True
+    return False
+
+
+def term_frequencies(postings, lengths):
+    # Each posting's count over its document length, computed once per PostingList.
+    # Scores weigh them with the idfs of the query, never with a stored tf-idf.
+    if postings.tfs is None:
+        doc_ids = np.frombuffer(postings.doc_ids, dtype=np.uint32)
+        postings.tfs = np.frombuffer(postings.counts, dtype=np.uint32) / lengths[doc_ids]
+    return postings.tfs
+
+
+def window_maxes(postings, lengths):
+    # The doc id windows a list has postings in, the index of its first posting in each
+    # and the largest term frequency there, computed once per PostingList
+    if postings.block_max is None:
+        doc_ids = np.frombuffer(postings.doc_ids, dtype=np.uint32)
+        windows = doc_ids // WINDOW
+        starts = np.flatnonzero(np.diff(windows, prepend=-1)) if len(windows) else np.zeros(0, dtype=np.int64)
+        postings.block_windows = windows[starts]
+        postings.block_starts = starts
+        postings.block_max = (np.maximum.reduceat(term_frequencies(postings, lengths), starts)
+                              if len(starts) else np.zeros(0))
+    return postings.block_windows, postings.block_starts, postings.block_max
+
+
+def wand_top_k(postings_lists, weights, lengths, k):
+    # Block-max pruning over windows of WINDOW consecutive doc ids shared by every
+    # term. A document's score is the sum of its tf-idf (term frequency times the
+    # term's weight, its idf) over the query terms. A window's upper bound sums the
+    # weighted per-window maxima of its terms; windows are scored exactly, a whole
+    # window at a time, in decreasing bound order until no remaining bound can beat
+    # the current k-th best. Only the bounds are scaled per query; term frequencies
+    # are read straight from the postings' arrays.
+    if len(postings_lists) == 1:
+        # A single list needs no merging: select its k best postings directly
+        postings = postings_lists[0]
+        scores = term_frequencies(postings, lengths)
+        best = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        return np.sort(np.frombuffer(postings.doc_ids, dtype=np.uint32)[best])
+
+    num_windows = len(lengths) // WINDOW + 1
+    bounds = np.zeros(num_windows)
+    present = np.zeros(num_windows, dtype=bool)
+    lists = []
+    for postings, weight in zip(postings_lists, weights):
+        windows, starts, block_max = window_maxes(postings, lengths)
+        bounds[windows] += weight * block_max
+        present[windows] = True
+        # where each window's postings start in this list, for every window
+        first = np.full(num_windows + 1, len(postings), dtype=np.int64)
+        first[windows] = starts
+        first = np.minimum.accumulate(first[::-1])[::-1]
+        lists.append((np.frombuffer(postings.doc_ids, dtype=np.uint32), term_frequencies(postings, lengths),
+                      weight, first))
+
+    best_ids = np.zeros(0, dtype=np.int64)
+    best_scores = np.zeros(0)
+    scores = np.zeros(WINDOW)
+    matched = np.zeros(WINDOW, dtype=bool)
+    order = np.flatnonzero(present)
+    for window in order[np.argsort(-bounds[order], kind='stable')].tolist():
+        # Ties with the k-th score go to the lower doc id, which a later window may hold
+        if len(best_ids) == k and bounds[window] < best_scores[-1]:
+            break
+        base = window * WINDOW
+        scores[:] = 0
+        matched[:] = False
+        for doc_ids, tfs, weight, first in lists:
+            lo, hi = first[window], first[window + 1]
+            local = doc_ids[lo:hi] - base
+            scores[local] += weight * tfs[lo:hi]
+            matched[local] = True
+        local = np.flatnonzero(matched)
+        if len(best_ids) == k:
+            local = local[scores[local] >= best_scores[-1]]
+
+        # Top k by decreasing score, then increasing doc id
+        best_ids = np.concatenate([best_ids, local + base])
+        best_scores = np.concatenate([best_scores, scores[local]])
+        top = np.lexsort((best_ids, -best_scores))[:k]
+        best_ids, best_scores = best_ids[top], best_scores[top]
+
+    return np.sort(best_ids).astype(np.uint32)
+
+
+def impact_top_k(postings_lists, weights, lengths, norms, k):
+    # Threshold algorithm over impact ordered postings: each round reads the next
+    # highest impact posting of every term and scores its document exactly (true
+    # cosine numerator over the document norm) through doc id lookups in the other
+    # lists. Once the k-th best score reaches the sum of the impacts at the current
+    # depth, no unseen document can enter the top k and evaluation stops.
+    # Impacts are term frequencies over document norms; weights carry the idfs.
+    lists = []
+    for postings, weight in zip(postings_lists, weights):
+        doc_ids = np.frombuffer(postings.doc_ids, dtype=np.uint32)
+        doc_norms = norms[doc_ids]
+        impacts = np.divide(term_frequencies(postings, lengths), doc_norms,
+                            out=np.zeros(len(doc_ids)), where=doc_norms > 0)
+        if postings.impacts is None:
+            # Within a term the order is the same whatever its idf
+            postings.impacts = array('I', np.argsort(-impacts, kind='stable').astype(np.uint32).tobytes())
+        lists.append((postings.doc_ids, impacts.tolist(), postings.impacts, weight))
+
+    heap = []
+    seen = set()
+    for depth in range(max(len(order) for _, _, order, _ in lists)):
+        threshold = 0
+        for doc_ids, impacts, order, weight in lists:
+            if depth >= len(order):
+                continue
+            i = order[depth]
+            threshold += weight * impacts[i]
+            doc_id = doc_ids[i]
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+
+            score = 0
+            for other_ids, other_impacts, _, other_weight in lists:
+                j = bisect_left(other_ids, doc_id)
+                if j < len(other_ids) and other_ids[j] == doc_id:
+                    score += other_weight * other_impacts[j]
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -doc_id))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, -doc_id))
+
+        if len(heap) == k and heap[0][0] >= threshold:
+            break
+
+    return np.array(sorted(-doc for _, doc in heap), dtype=np.uint32)
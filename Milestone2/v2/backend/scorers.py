@@ -0,0 +1,120 @@
+import numpy as np
+
+
+def normalize_score(score, minimum, maximum):
+    if maximum == minimum:
+        return np.ones_like(score)
+    return 1 + ((score - minimum) / (maximum - minimum))
+
+
+class Scorer():
+
+    # A ranking model over the Candidates of a parsed query. Its per-candidate score
+    # arrays come in two stages: first_stage ones are cheap, computed from postings
+    # alone for every candidate; second_stage ones (e.g. from positions) may only be
+    # computed for the best candidates by first_stage_score. bounds summarizes the
+    # first stage over all candidates for models that normalize (None otherwise), and
+    # combine turns the components of both stages into the final scores. A sharded
+    # search merges the shards' bounds before combining, so every shard's candidates
+    # are scored on the same scale.
+    def first_stage(self, engine, query, candidates):
+        raise NotImplementedError
+
+    def second_stage(self, engine, query, candidates):
+        return ()
+
+    def bounds(self, components):
+        return None
+
+    def merge_bounds(self, shard_bounds):
+        return None
+
+    def first_stage_score(self, first, bounds):
+        raise NotImplementedError
+
+    def combine(self, components, bounds):
+        raise NotImplementedError
+
+
+class ClassicScorer(Scorer):
+
+    # Cosine similarity times tf-idf sum, both min-max normalized over the candidates,
+    # times the proximity and tag multipliers of the second stage
+    def first_stage(self, engine, query, candidates):
+        return engine.cosine_similarity(query, candidates), engine.tfidf_sum(query, candidates)
+
+    def second_stage(self, engine, query, candidates):
+        return engine.score_proximity(query, candidates), engine.score_tags(candidates)
+
+    def bounds(self, components):
+        cosine, tfidf = components[0], components[1]
+        return cosine.min(), cosine.max(), tfidf.min(), tfidf.max()
+
+    def merge_bounds(self, shard_bounds):
+        return (min(b[0] for b in shard_bounds), max(b[1] for b in shard_bounds),
+                min(b[2] for b in shard_bounds), max(b[3] for b in shard_bounds))
+
+    def first_stage_score(self, first, bounds):
+        cosine, tfidf = first
+        cosine_min, cosine_max, tfidf_min, tfidf_max = bounds
+        return normalize_score(cosine, cosine_min, cosine_max) * normalize_score(tfidf, tfidf_min, tfidf_max)
+
+    def combine(self, components, bounds):
+        cosine, tfidf, proximity, tags = components
+        cosine_min, cosine_max, tfidf_min, tfidf_max = bounds
+        return (normalize_score(cosine, cosine_min, cosine_max)
+                * normalize_score(tfidf, tfidf_min, tfidf_max) * proximity * tags)
+
+
+class BM25FScorer(Scorer):
+
+    # BM25F: a term's frequency in the whole document and in each of FIELDS is
+    # normalized by that stream's length relative to its average, the weighted sum
+    # saturates through k1, and is weighted by the term's BM25 idf. Everything is
+    # computed at once over the candidate arrays from the postings and the stored
+    # document and field lengths; no positions are read.
+    def __init__(self, k1=1.2, b=0.75, field_weights=(3.0, 2.0, 1.5), field_b=(0.5, 0.5, 0.5)):
+        # field_weights and field_b follow FIELDS; the whole document has weight 1
+        self.k1 = k1
+        self.b = b
+        self.field_weights = np.array(field_weights)
+        self.field_b = np.array(field_b)
+
+    def _idfs(self, query, candidates):
+        stats = query.stats
+        doc_freqs = np.array([stats.doc_freq(token) or 0 for token in candidates.terms], dtype=np.float64)
+        return np.log(1 + (stats.num_documents - doc_freqs + 0.5) / (doc_freqs + 0.5))
+
+    def first_stage(self, engine, query, candidates):
+        stats = query.stats
+        docs = query.snapshot.docs
+        lengths = engine._doc_lengths(docs)[candidates.doc_ids]
+        field_lengths = engine._doc_field_lengths(docs)[candidates.doc_ids]
+        avg_field_lengths = np.array(stats.avg_field_lengths)
+
+        doc_norm = 1 - self.b + self.b * lengths / (stats.avg_doc_length or 1)
+        relative = np.divide(field_lengths, avg_field_lengths, out=np.zeros(field_lengths.shape),
+                             where=avg_field_lengths > 0)
+        field_norm = 1 - self.field_b + self.field_b * relative
+        # (candidates, terms): weighted, length normalized frequency over all streams
+        tf = candidates.counts / doc_norm[:, None]
+        tf += (candidates.fields * (self.field_weights / field_norm)[:, None, :]).sum(axis=2)
+
+        query_counts = np.array([query.counts[token] for token in candidates.terms])
+        weights = self._idfs(query, candidates) * query_counts
+        return ((tf * (self.k1 + 1) / (tf + self.k1)) @ weights,)
+
+    def first_stage_score(self, first, bounds):
+        return first[0]
+
+    def combine(self, components, bounds):
+        return components[0]
+
+
+# Ranking models selectable by name
+SCORERS = {'classic': ClassicScorer, 'bm25f': BM25FScorer}
+
+
+def make_scorer(scorer):
+    # A Scorer instance, or the name of one in SCORERS
+    return SCORERS[scorer]() if isinstance(scorer, str) else scorer
@@ -1,183 +1,551 @@
 from token_utils import TokenUtils
-
-import math
+from cache import LRUCache
+from query_log import QueryLog
+from retrieval import wand_top_k, impact_top_k, intersect, phrase_match
+from scorers import normalize_score, make_scorer
+from postings import FIELDS
+from disk_index import BlockPostings
+
+import copy
+import numpy as np
+import threading
 from collections import Counter
-from sklearn.metrics.pairwise import cosine_similarity
-
-class SearchResult():
-    
-    def __init__(self, loc, url, title, score=1):
-        self.loc = loc
-        self.url = url
-        self.title = title
-        self.score = score
-        self.postings =  {}
-
-    def insert(self, token, p):
-        self.postings[token] = p
-
-    def update_score(self, val):
-        self.score *= val
+from functools import partial
+
+
+# Marks a result cache miss, since a query without matches caches None
+MISSING = object()
+
+
+def merge_shards(responses, k, scorer, rerank_depth=None):
+    # Combines SearchEngine.search_shard responses, from shards of contiguous slices of
+    # the corpus in order, into the top k of the whole corpus. Ties break as in a single
+    # index: by the first query term a document matches, then by its position in that
+    # term's postings, i.e. by shard and then rank within the shard. With rerank_depth,
+    # the shards selected by merged bounds and sent their rerank_depth best with their
+    # first stage scores, and only the best of those over all shards are reranked.
+    results = [(shard, result) for shard, response in enumerate(responses) for result in response[1]]
+    if not results:
+        return
+    bounds = scorer.merge_bounds([response[2] for response in responses if response[1]])
+    ties = (np.array([result[3][1] for _, result in results]), np.array([shard for shard, _ in results]),
+            np.array([result[3][0] for _, result in results]))
+    if rerank_depth is not None:
+        first_scores = np.array([result[4] for _, result in results])
+        selected = np.lexsort(ties + (-first_scores,))[:max(rerank_depth, k)]
+        results = [results[r] for r in selected]
+        ties = tuple(tie[selected] for tie in ties)
+    components = tuple(np.array([result[5][i] for _, result in results]) for i in range(len(results[0][1][5])))
+    scores = scorer.combine(components, bounds)
+
+    order = np.lexsort(ties + (-scores,))[:k]
+    urls = [results[r][1][:3] + (float(scores[r]),) for r in order]
+    return sum(response[0] for response in responses), urls
+
+
+class ParsedQuery():
+
+    def __init__(self, text, tokens):
+        self.text = text
+        self.tokens = tokens
+        self.counts = Counter(tokens)
+        # Only terms present in the index get an idf and a query tf-idf weight
+        self.idfs = {}
+        self.vector = {}
+        # TermStats the query was parsed with, and the index snapshot it is searched in
+        self.stats = None
+        self.snapshot = None
+
+
+class Candidates():
+
+    def __init__(self, postings, doc_ids=None):
+        # postings: query term -> PostingList, for the query terms found in the index;
+        # doc_ids restricts the candidates to a subset of the matching documents
+        self.terms = list(postings)
+        self.postings = list(postings.values())
+        doc_lists = [np.frombuffer(p.doc_ids, dtype=np.uint32) for p in self.postings]
+        if doc_ids is None:
+            doc_ids = np.unique(np.concatenate(doc_lists))
+        self.doc_ids = np.sort(doc_ids)
+
+        # rows[r, j] is the index of candidate r's posting in term j's list, or -1.
+        # rank is the position of each document's first appearance when walking the
+        # terms' postings in query order, and breaks score ties
+        n, k = len(self.doc_ids), len(self.terms)
+        self.rows = np.full((n, k), -1, dtype=np.int64)
+        self.rank = np.full(n, -1, dtype=np.int64)
+        offset = 0
+        for j, ids in enumerate(doc_lists):
+            idx = np.searchsorted(ids, self.doc_ids)
+            found = ids[np.minimum(idx, len(ids) - 1)] == self.doc_ids
+            self.rows[found, j] = idx[found]
+            first = found & (self.rank < 0)
+            self.rank[first] = offset + idx[first]
+            offset += len(ids)
+        self.present = self.rows >= 0
+
+        self.counts = np.zeros((n, k))
+        self.tags = np.zeros((n, k))
+        for j, p in enumerate(self.postings):
+            rows = self.rows[self.present[:, j], j]
+            self.counts[self.present[:, j], j] = np.frombuffer(p.counts, dtype=np.uint32)[rows]
+            self.tags[self.present[:, j], j] = np.frombuffer(p.tags, dtype=np.uint8)[rows]
+        # Field frequencies are only gathered for the scorers that read them
+        self._fields = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @property
+    def fields(self):
+        # fields[r, j, f]: frequency of term j in field f of candidate r
+        if self._fields is None:
+            self._fields = np.zeros((len(self.doc_ids), len(self.terms), len(FIELDS)))
+            for j, p in enumerate(self.postings):
+                rows = self.rows[self.present[:, j], j]
+                self._fields[self.present[:, j], j] = np.frombuffer(p.fields, dtype=np.uint8).reshape(-1, len(FIELDS))[rows]
+        return self._fields
+
+    def subset(self, selected):
+        # The candidates at the sorted row indices selected, sharing the postings
+        subset = copy.copy(self)
+        for name in ('doc_ids', 'rows', 'rank', 'present', 'counts', 'tags'):
+            setattr(subset, name, getattr(self, name)[selected])
+        if self._fields is not None:
+            subset._fields = self._fields[selected]
+        return subset
 
 
 class SearchEngine():
 
-    def __init__(self, indexer, logs_path):
+    def __init__(self, indexer, logs_path, fast_tokenizer=False, query_cache_size=1024, prune_depth=10,
+                 result_cache_size=4096, result_cache_ttl=None, scorer='classic', rerank_depth=None,
+                 query_log_path=None):
         self.indexer = indexer
         self.logs_path = logs_path
-        self.utils = TokenUtils()
-
-
-    def _get_all_results(self, query):
-        query_tokens = self.utils.tokenize(query)
-        search_results = {}
-        for token in query_tokens:
-            if token in self.indexer.inverted_index:
-                for posting in self.indexer.inverted_index[token]:
-                    if posting.url in search_results:
-                        search_results[posting.url].insert(token, posting)
-                    else:
-                        search_results[posting.url] = SearchResult(posting.loc, posting.url, posting.title)
-                        search_results[posting.url].insert(token, posting)
-        
-        return list(search_results.values())
+        # Queries searched here are appended to the query log, and warm_up reads it
+        self.query_log = QueryLog(query_log_path) if query_log_path else None
+        # Ranking model: a name in scorers.SCORERS or a Scorer instance
+        self.scorer = make_scorer(scorer)
+        # With pruned retrieval, prune_depth * k documents go through the full ranking
+        self.prune_depth = prune_depth
+        # Two-stage ranking: only the rerank_depth best candidates by the scorer's cheap
+        # first stage get its second stage (None ranks every candidate with both)
+        self.rerank_depth = rerank_depth
+        # spaCy model, loaded by the first query tokenized here (shard processes get
+        # their queries tokenized and never load one)
+        self.fast_tokenizer = fast_tokenizer
+        self._utils = None
+        self.utils_lock = threading.Lock()
+        self.query_cache = LRUCache(query_cache_size)
+        # Ranked results by (index version, query tokens, k, retrieval mode); both caches
+        # are emptied when a new index version is loaded
+        self.result_cache = LRUCache(result_cache_size, result_cache_ttl)
+        self.index_version = indexer.version
+
+
+    @property
+    def utils(self):
+        with self.utils_lock:
+            if self._utils is None:
+                self._utils = TokenUtils(fast=self.fast_tokenizer)
+            return self._utils
+
+
+    def _snapshot(self):
+        # Index snapshot a new search runs against, taken once and read all the way
+        # through the search
+        self.indexer.refresh_index()
+        snapshot = self.indexer.snapshot
+        if self.index_version != snapshot.version:
+            self.query_cache.clear()
+            self.result_cache.clear()
+            self.index_version = snapshot.version
+        return snapshot
+
+
+    def cache_stats(self):
+        stats = {'index_version': self.index_version, 'queries': self.query_cache.stats(),
+                 'results': self.result_cache.stats()}
+        postings_cache = getattr(self.indexer.snapshot.inverted_index, 'cache', None)
+        if postings_cache is not None:
+            stats['postings'] = postings_cache.stats()
+        return stats
+
+
+    def warm_up(self, max_queries=1000):
+        # Loads the postings of the terms of the most frequent logged queries, weighted
+        # by how often those queries were searched
+        if self.query_log is None:
+            return 0
+        top = self.query_log.most_common(max_queries)
+        if not top:
+            return 0
+
+        token_uses = Counter()
+        for parsed, (_, frequency) in zip(self.analyze_many([query for query, _ in top]), top):
+            for token in parsed.vector:
+                token_uses[token] += frequency
+        return self.indexer.warm_postings(token_uses)
+
+
+    def analyze(self, query):
+        # Tokenizes the query and builds its tf-idf vector once for all scoring stages.
+        # A cached query parsed against an older snapshot is parsed again.
+        snapshot = self._snapshot()
+        parsed = self.query_cache.get(query)
+        if parsed is not None and parsed.snapshot is snapshot:
+            return parsed
+
+        return self._parse(query, self.utils.tokenize_query(query), snapshot)
+
+
+    def analyze_many(self, queries):
+        # Queries missing from the cache are tokenized together in one pipeline batch
+        snapshot = self._snapshot()
+        parsed = [self.query_cache.get(query) for query in queries]
+        parsed = [p if p is not None and p.snapshot is snapshot else None for p in parsed]
+        missing = list({query for query, p in zip(queries, parsed) if p is None})
+        if missing:
+            analyzed = {query: self._parse(query, tokens, snapshot)
+                        for query, tokens in zip(missing, self.utils.tokenize_queries(missing))}
+            parsed = [p if p is not None else analyzed[query] for query, p in zip(queries, parsed)]
+        return parsed
+
+
+    def _parse(self, query, tokens, snapshot, stats=None):
+        # Idfs come from the snapshot's term statistics, or from stats (the TermStats
+        # of a whole sharded corpus) in which case the parsed query is not cached
+        term_stats = stats if stats is not None else snapshot.stats
+        parsed = ParsedQuery(query, tokens)
+        parsed.stats = term_stats
+        parsed.snapshot = snapshot
+        for token, count in parsed.counts.items():
+            idf = term_stats.idf(token)
+            if idf is None:
+                continue
+            parsed.idfs[token] = idf
+            parsed.vector[token] = count / len(parsed.tokens) * idf
+
+        if stats is None:
+            self.query_cache.put(query, parsed)
+        return parsed
+
+
+    def _get_postings(self, query, fetched=None, blocks=False):
+        # fetched: postings already read for other queries of the same batch
+        # blocks: lists much longer than the shortest may come undecoded, as
+        # BlockPostings (for intersect)
+        # Terms that only occur in other shards have no postings here
+        index = query.snapshot.inverted_index
+        get, probes = index.get, None
+        if blocks and hasattr(index, 'get_blocks'):
+            probes = min((index.doc_freq(token) for token in query.vector), default=0)
+            get = partial(index.get_blocks, probes=probes)
+        postings = {}
+        for token in query.vector:
+            if fetched is None:
+                term_postings = get(token)
+            else:
+                key = token if probes is None else (token, probes)
+                if key not in fetched:
+                    fetched[key] = get(token)
+                term_postings = fetched[key]
+            if term_postings is not None:
+                postings[token] = term_postings
+        return postings
+
+
+    def _get_all_results(self, query, fetched=None):
+        postings = self._get_postings(query, fetched)
+        if not postings:
+            return None
+
+        return Candidates(postings)
+
+
+    def _doc_norms(self, docs):
+        return np.frombuffer(docs.norms, dtype=np.float64)
+
+
+    def _doc_lengths(self, docs):
+        return np.frombuffer(docs.lengths, dtype=np.uint32)
+
+
+    def _doc_field_lengths(self, docs):
+        return np.frombuffer(docs.field_lengths, dtype=np.uint32).reshape(-1, len(FIELDS))
+
+
+    def _get_conjunctive_results(self, query, phrase, fetched=None):
+        # AND: documents containing every query term; phrase: the terms must also
+        # occur at consecutive positions in query order
+        postings = self._get_postings(query, fetched, blocks=True)
+        if not postings or len(postings) < len(query.counts):
+            return None
+
+        terms = list(postings)
+        doc_ids, rows = intersect([p.doc_ids for p in postings.values()])
+        matched = range(len(doc_ids))
+        if phrase and len(query.tokens) > 1:
+            columns = {token: j for j, token in enumerate(terms)}
+            matched = [r for r in matched
+                       if phrase_match([postings[token].idx_list(rows[columns[token]][r]) for token in query.tokens])]
+        if not matched:
+            return None
+
+        doc_ids = [doc_ids[r] for r in matched]
+        # Postings still packed are decoded for the matches alone
+        for j, token in enumerate(terms):
+            if isinstance(postings[token], BlockPostings):
+                postings[token] = postings[token].select([rows[j][r] for r in matched], doc_ids)
+        return Candidates(postings, np.array(doc_ids, dtype=np.uint32))
+
+
+    def _get_pruned_results(self, query, k, retrieval, fetched=None):
+        # Only the documents with the best first-stage scores go through the full
+        # ranking: tf-idf sums with Block-Max WAND, or true cosine with the threshold
+        # algorithm over impact ordered postings. Both weigh term frequencies with the
+        # query's idfs.
+        postings = self._get_postings(query, fetched)
+        if not postings:
+            return None, 0
+
+        depth = max(k * self.prune_depth, k)
+        docs = query.snapshot.docs
+        if retrieval == 'wand':
+            doc_ids = wand_top_k(list(postings.values()), [query.idfs[token] for token in postings],
+                                 self._doc_lengths(docs), depth)
+        else:
+            doc_ids = impact_top_k(list(postings.values()),
+                                   [query.vector[token] * query.idfs[token] for token in postings],
+                                   self._doc_lengths(docs), self._doc_norms(docs), depth)
+        if len(postings) == 1:
+            num_results = len(next(iter(postings.values())))
+        else:
+            # Size of the union, counted on a bitmap of the documents
+            matches = np.zeros(len(docs), dtype=bool)
+            for term_postings in postings.values():
+                matches[np.frombuffer(term_postings.doc_ids, dtype=np.uint32)] = True
+            num_results = int(np.count_nonzero(matches))
+        return Candidates(postings, doc_ids), num_results
     
 
-    def search(self, query):
-        results = self._get_all_results(query)
-        if not results:
+    def _top_k(self, candidates, scores, k):
+        # Selects the k best candidates in linear time and only sorts those; every
+        # candidate tied with the k-th score is kept so ties still break by match order
+        if len(scores) > k:
+            kth_score = -np.partition(-scores, k - 1)[k - 1]
+            selected = np.nonzero(scores >= kth_score)[0]
+        else:
+            selected = np.arange(len(scores))
+        order = np.lexsort((candidates.rank[selected], -scores[selected]))
+
+        return selected[order[:k]]
+
+
+    def search(self, query, k=20, retrieval='all'):
+        # retrieval: 'all' ranks every match, 'wand' or 'impact' prune candidates first,
+        # 'and' and 'phrase' only match documents with every term (a quoted query is a phrase)
+        if self.query_log is not None:
+            self.query_log.append([query])
+        return self._search(self.analyze(query), k, retrieval)
+
+
+    def search_many(self, queries, k=20, retrieval='all'):
+        # Results in query order; repeated queries are ranked once and postings of
+        # terms shared between queries are read once
+        if self.query_log is not None:
+            self.query_log.append(queries)
+        fetched = {}
+        results = {}
+        for query in self.analyze_many(queries):
+            if query.text not in results:
+                results[query.text] = self._search(query, k, retrieval, fetched)
+        return [results[query] for query in queries]
+
+
+    def _search(self, query, k, retrieval, fetched=None):
+        if len(query.text) > 1 and query.text.startswith('"') and query.text.endswith('"'):
+            retrieval = 'phrase'
+        # Queries that normalize to the same tokens share their results
+        key = (query.snapshot.version, tuple(query.tokens), k, retrieval)
+        response = self.result_cache.get(key, MISSING)
+        if response is MISSING:
+            response = self._rank(query, k, retrieval, fetched)
+            self.result_cache.put(key, response)
+        return response
+
+
+    def _get_candidates(self, query, k, retrieval, fetched=None):
+        if retrieval in ('and', 'phrase'):
+            candidates = self._get_conjunctive_results(query, retrieval == 'phrase', fetched)
+            numURLS = len(candidates) if candidates is not None else 0
+        elif retrieval != 'all':
+            candidates, numURLS = self._get_pruned_results(query, k, retrieval, fetched)
+        else:
+            candidates = self._get_all_results(query, fetched)
+            numURLS = len(candidates) if candidates is not None else 0
+        return candidates, numURLS
+
+
+    def _score(self, query, candidates, k):
+        # Candidates left after the first stage, their score components and the
+        # first stage bounds over every candidate
+        first = self.scorer.first_stage(self, query, candidates)
+        bounds = self.scorer.bounds(first)
+        if self.rerank_depth is not None and len(candidates) > max(self.rerank_depth, k):
+            first_scores = self.scorer.first_stage_score(first, bounds)
+            selected = np.sort(self._top_k(candidates, first_scores, max(self.rerank_depth, k)))
+            candidates = candidates.subset(selected)
+            first = tuple(component[selected] for component in first)
+        components = first + tuple(self.scorer.second_stage(self, query, candidates))
+        return candidates, components, bounds
+
+
+    def _rank(self, query, k, retrieval, fetched):
+        candidates, numURLS = self._get_candidates(query, k, retrieval, fetched)
+        if candidates is None:
             return
-        results = self.score_cosine_similarity(query, results)
-        results = self.score_tfidf(results)
-        results = self.score_proximity(query, results)
-        results = self.score_tags(results)
-
-        # Final score sorting
-        sorted_results = sorted(results, key=lambda x: -x.score)
+        candidates, components, bounds = self._score(query, candidates, k)
+        scores = self.scorer.combine(components, bounds)
 
-        urls = [(sr.url, sr.title, sr.loc, sr.score) for sr in sorted_results]
-        numURLS = len(urls)
-        return numURLS, urls[:20]
-    
+        urls = []
+        for r in self._top_k(candidates, scores, k):
+            loc, url, title = query.snapshot.docs[int(candidates.doc_ids[r])]
+            urls.append((url, title, loc, float(scores[r])))
+        return numURLS, urls
 
-    def tfidf_vectorize(self, query, sr):
-        query_vector = []
-        sr_vector = []
-        query_tokens = self.utils.tokenize(query)
-        tokens_dict = Counter(query_tokens)
-        for token, count in tokens_dict.items():            
-            if token not in self.indexer.inverted_index:
-                continue
 
-            dft = len(self.indexer.inverted_index[token])
-            idf = math.log(self.indexer.num_documents / dft)
-
-            query_tf = count / len(query_tokens)
-            query_tfidf = query_tf * idf
-            query_vector.append(query_tfidf)
-            
-            if token in sr.postings:
-                sr_tf = sr.postings[token].frequency
-                sr_tfidf = sr_tf * idf
-                sr_vector.append(sr_tfidf)
-            else:
-                sr_vector.append(0)
+    def _shard_candidates(self, text, tokens, k, retrieval, stats):
+        if len(text) > 1 and text.startswith('"') and text.endswith('"'):
+            retrieval = 'phrase'
+        query = self._parse(text, tokens, self._snapshot(), stats)
+        candidates, numURLS = self._get_candidates(query, k, retrieval)
+        return query, candidates, numURLS
 
-        # print(query_vector, sr_vector)
 
-        return [query_vector], [sr_vector]
+    def shard_bounds(self, text, tokens, k, retrieval, stats):
+        # First round of a reranked sharded search: this shard's first stage bounds,
+        # or None without matches
+        query, candidates, _ = self._shard_candidates(text, tokens, k, retrieval, stats)
+        if candidates is None:
+            return
+        return (self.scorer.bounds(self.scorer.first_stage(self, query, candidates)),)
+
+
+    def search_shard(self, text, tokens, k, retrieval, stats, bounds=MISSING):
+        # One shard's part of a sharded search. A scorer may normalize over all matches
+        # of the corpus, so the score components are returned raw and the front end
+        # combines them with the merged bounds. Without bounds, the prune_depth * k best
+        # results by this shard's own scores are returned, as a superset of its share of
+        # the global top k. With the merged bounds, the rerank_depth best by first stage
+        # score are returned, a superset of its share of the corpus-wide rerank_depth best.
+        query, candidates, numURLS = self._shard_candidates(text, tokens, k, retrieval, stats)
+        if candidates is None:
+            return 0, [], None
+        if bounds is MISSING:
+            candidates, components, bounds = self._score(query, candidates, k)
+            rows = self._top_k(candidates, self.scorer.combine(components, bounds), max(k * self.prune_depth, k))
+            first_scores = np.zeros(len(candidates))
+        else:
+            first = self.scorer.first_stage(self, query, candidates)
+            first_scores = self.scorer.first_stage_score(first, bounds)
+            selected = np.sort(self._top_k(candidates, first_scores, max(self.rerank_depth, k)))
+            candidates = candidates.subset(selected)
+            first_scores = first_scores[selected]
+            components = (tuple(component[selected] for component in first)
+                          + tuple(self.scorer.second_stage(self, query, candidates)))
+            rows = range(len(candidates))
+
+        # Index of the first query term each candidate matches, for the tie breaking
+        first_terms = np.argmax(candidates.present, axis=1)
+        results = []
+        for r in rows:
+            loc, url, title = query.snapshot.docs[int(candidates.doc_ids[r])]
+            results.append((url, title, loc, (int(first_terms[r]), int(candidates.rank[r])), float(first_scores[r]),
+                            tuple(component[r] for component in components)))
+        return numURLS, results, bounds
+
+
+    def tfidf_vectorize(self, query, candidates):
+        # Query tf-idf vector and one document tf-idf row per candidate over the query
+        # terms that have postings
+        query_vector = np.array([query.vector[token] for token in candidates.terms])
+        idfs = np.array([query.idfs[token] for token in candidates.terms])
+        lengths = self._doc_lengths(query.snapshot.docs)[candidates.doc_ids]
+        result_vectors = candidates.counts / lengths[:, None] * idfs
+
+        return query_vector, result_vectors
     
 
-    def score_cosine_similarity(self, query, results):
-        score_list = []
-
-        for result in results:
-            query_vector, result_vector = self.tfidf_vectorize(query, result)
-            cosine_score = cosine_similarity(query_vector, result_vector)
-            score_list.append(cosine_score)
-        # print(score_list)
-        max_score = max(score_list)
-        min_score = min(score_list)
-
-        for idx in range(len(results)):
-            score = self.normalize_score(score_list[idx],
-                                          minimum=min_score,
-                                          maximum=max_score)
-            results[idx].update_score(score)
-            
-        return results
-            
-        
-    def score_tfidf(self, results):
-        score_list = []
-        
-        for result in results:
-            tfidf_score = sum([p.tfidf for p in result.postings.values()])
-            score_list.append(tfidf_score)
-
-        max_score = max(score_list)
-        min_score = min(score_list)
-
-        for idx in range(len(results)):
-            score = self.normalize_score(score_list[idx],
-                                          minimum=min_score,
-                                          maximum=max_score)
-            results[idx].update_score(score)
-        return results
+    def cosine_similarity(self, query, candidates):
+        # True cosine: the document side is normalized by its full tf-idf vector norm,
+        # precomputed at index time, not just by its weights on the query terms
+        query_vector, result_vectors = self.tfidf_vectorize(query, candidates)
+
+        query_norm = np.linalg.norm(list(query.vector.values()))
+        norms = self._doc_norms(query.snapshot.docs)[candidates.doc_ids] * query_norm
+        return np.divide(result_vectors @ query_vector, norms,
+                         out=np.zeros(len(candidates)), where=norms > 0)
+
+
+    def tfidf_sum(self, query, candidates):
+        # Computed from the counts with the query's idfs rather than the stored tf-idf,
+        # so it follows the statistics the query was parsed with
+        _, result_vectors = self.tfidf_vectorize(query, candidates)
+        return result_vectors.sum(axis=1)
+
+
+    def _count_adjacent(self, idx_list1, idx_list2):
+        adjacent_pairs = 0
+        idx1 = idx2 = 0
+        while idx1 < len(idx_list1) and idx2 < len(idx_list2):
+            if abs(idx_list1[idx1] - idx_list2[idx2]) == 1:
+                adjacent_pairs += 1
+                idx1 += 1
+                idx2 += 1
+            elif idx_list1[idx1] <  idx_list2[idx2]:
+                idx1 += 1
+            else:
+                idx2 += 1
+        return adjacent_pairs
 
         
-    def score_proximity(self, query, results):
+    def score_proximity(self, query, candidates):
 
         def calc_adjacency_coeff(adjacent_pairs):
             return (-1 / ((adjacent_pairs + 1) / 4)) + 5
-            
-        query = self.utils.tokenize(query)
-        for result in results:
-            adjacent_pairs = 0
-            for token_idx in range(1, len(query)):
-                t1 = query[token_idx]
-                t2 = query[token_idx-1]
-                if t1 in result.postings and t2 in result.postings:
-                    p1 = result.postings[t1]
-                    p2 = result.postings[t2]
-                    idx1 = idx2 = 0
-
-                    while idx1 < len(p1.idx_list) and idx2 < len(p2.idx_list):
-                        if abs(p1.idx_list[idx1] - p2.idx_list[idx2]) == 1:
-                            adjacent_pairs += 1
-                            idx1 += 1
-                            idx2 += 1
-                        elif p1.idx_list[idx1] <  p2.idx_list[idx2]:
-                            idx1 += 1
-                        else:
-                            idx2 += 1
-                    
-            adj_score = calc_adjacency_coeff(adjacent_pairs)
-
-            adj_score = self.normalize_score(adj_score,
-                                             minimum=1,
-                                             maximum=5)
-
-            result.update_score(adj_score) 
-        
-        return results
+
+        adjacent_pairs = np.zeros(len(candidates))
+        columns = {token: j for j, token in enumerate(candidates.terms)}
+        query = query.tokens
+        for token_idx in range(1, len(query)):
+            t1 = query[token_idx]
+            t2 = query[token_idx-1]
+            if t1 not in columns or t2 not in columns:
+                continue
+            j1, j2 = columns[t1], columns[t2]
+            p1, p2 = candidates.postings[j1], candidates.postings[j2]
+            # Only documents containing both terms can have adjacent pairs
+            for r in np.nonzero(candidates.present[:, j1] & candidates.present[:, j2])[0]:
+                adjacent_pairs[r] += self._count_adjacent(p1.idx_list(candidates.rows[r, j1]),
+                                                          p2.idx_list(candidates.rows[r, j2]))
+
+        adj_score = calc_adjacency_coeff(adjacent_pairs)
+
+        return self.normalize_score(adj_score,
+                                    minimum=1,
+                                    maximum=5)
 
     
 
-    def score_tags(self, results):
-        for result in results:
-            tags_score = 1
-            for posting in result.postings.values():
-                if posting.tag_important:
-                    tags_score += 0.5
-            result.update_score(tags_score)
-        return results
+    def score_tags(self, candidates):
+        return 1 + 0.5 * candidates.tags.sum(axis=1)
         
 
     def normalize_score(self, score, minimum, maximum):
-        if maximum == minimum:
-            return 1
-        return 1 + ((score - minimum) / (maximum - minimum))
+        return normalize_score(score, minimum, maximum)
     
     
     def save_response(self, query, response):
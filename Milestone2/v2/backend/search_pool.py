@@ -0,0 +1,207 @@
+import asyncio
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from json import load as jload
+
+from index import Indexer
+from search import SearchEngine, merge_shards, MISSING
+from cache import LRUCache
+from scorers import make_scorer
+from shards import SHARDS_FILE
+from query_log import QueryLog
+from term_stats import load_term_stats
+from token_utils import TokenUtils
+
+
+# Engine of a pool or shard process, opened once by the process initializer
+_engine = None
+
+
+def open_engine(index_dir, query_log_path, fast_tokenizer=False, postings_cache_bytes=0, scorer='classic',
+                rerank_depth=None):
+    # The index files are mapped read only, so every process that opens them shares
+    # the same page cache pages instead of holding its own copy of the index. Only
+    # the decoded postings of hot terms, warmed up from the query log, are per process.
+    indexer = Indexer(None, None, None)
+    indexer.load_index(index_dir, postings_cache_bytes)
+    search_engine = SearchEngine(indexer, None, fast_tokenizer=fast_tokenizer, scorer=scorer,
+                                 rerank_depth=rerank_depth, query_log_path=query_log_path)
+    search_engine.warm_up()
+    return search_engine
+
+
+def _init_worker(index_dir, query_log_path, fast_tokenizer, postings_cache_bytes, scorer, rerank_depth):
+    global _engine
+    _engine = open_engine(index_dir, query_log_path, fast_tokenizer, postings_cache_bytes, scorer, rerank_depth)
+
+
+def _search(query, k, retrieval):
+    return _engine.search(query, k=k, retrieval=retrieval)
+
+
+def _search_many(queries, k, retrieval):
+    return _engine.search_many(queries, k=k, retrieval=retrieval)
+
+
+def _cache_stats():
+    return _engine.cache_stats()
+
+
+class SearchPool():
+
+    def __init__(self, index_dir, query_log_path, workers=None, processes=False, fast_tokenizer=False,
+                 postings_cache_bytes=0, scorer='classic', rerank_depth=None):
+        # processes: score in worker processes, each mapping the index itself, so that
+        # pure Python scoring is not serialized by the GIL; otherwise threads share one engine.
+        # Searched queries are appended to the query log at query_log_path.
+        if processes:
+            self.engine = None
+            self.executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                initargs=(index_dir, query_log_path, fast_tokenizer,
+                                                          postings_cache_bytes, scorer, rerank_depth))
+        else:
+            self.engine = open_engine(index_dir, query_log_path, fast_tokenizer, postings_cache_bytes, scorer,
+                                      rerank_depth)
+            self.executor = ThreadPoolExecutor(workers)
+
+
+    async def search(self, query, k=20, retrieval='all'):
+        # Runs the CPU bound search off the event loop
+        loop = asyncio.get_running_loop()
+        if self.engine is None:
+            return await loop.run_in_executor(self.executor, _search, query, k, retrieval)
+        return await loop.run_in_executor(self.executor, partial(self.engine.search, query, k=k, retrieval=retrieval))
+
+
+    async def search_many(self, queries, k=20, retrieval='all'):
+        loop = asyncio.get_running_loop()
+        if self.engine is None:
+            return await loop.run_in_executor(self.executor, _search_many, queries, k, retrieval)
+        return await loop.run_in_executor(self.executor, partial(self.engine.search_many, queries, k=k, retrieval=retrieval))
+
+
+    async def cache_stats(self):
+        # With worker processes these are the counters of whichever process answers
+        if self.engine is None:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, _cache_stats)
+        return self.engine.cache_stats()
+
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def _shard_search(text, tokens, k, retrieval, stats, bounds=MISSING):
+    return _engine.search_shard(text, tokens, k, retrieval, stats, bounds)
+
+
+def _shard_bounds(text, tokens, k, retrieval, stats):
+    return _engine.shard_bounds(text, tokens, k, retrieval, stats)
+
+
+def _shard_warm(token_uses):
+    return _engine.indexer.warm_postings(token_uses)
+
+
+class ShardedSearchPool():
+
+    def __init__(self, index_dir, query_log_path, fast_tokenizer=False, postings_cache_bytes=0,
+                 scorer='classic', rerank_depth=None, result_cache_size=4096, result_cache_ttl=None,
+                 warm_queries=1000):
+        # One process per shard; a query is tokenized once here and sent to every
+        # shard with the corpus-wide statistics of its terms. Shard processes never
+        # tokenize, so they load no spaCy model.
+        with open(os.path.join(index_dir, SHARDS_FILE), 'r') as f:
+            self.meta = jload(f)
+        self.stats = load_term_stats(index_dir)
+        self.executors = [ProcessPoolExecutor(1, initializer=_init_worker,
+                                              initargs=(os.path.join(index_dir, name), None,
+                                                        False, postings_cache_bytes, scorer, rerank_depth))
+                          for name in self.meta['shards']]
+        self.query_log = QueryLog(query_log_path) if query_log_path else None
+        # Combines the shards' score components, so it must be the shards' own model
+        self.scorer = make_scorer(scorer)
+        self.rerank_depth = rerank_depth
+        self.utils = TokenUtils(fast=fast_tokenizer)
+        self.tokenizer = ThreadPoolExecutor(1)
+        # Merged results by (query tokens, k, retrieval mode), as in SearchEngine. A
+        # sharded index is never updated in place, so entries only leave by eviction.
+        self.result_cache = LRUCache(result_cache_size, result_cache_ttl)
+        self._warm_up(warm_queries)
+
+
+    def _warm_up(self, max_queries):
+        # The shards' postings caches are warmed with the terms of the most frequent
+        # logged queries, tokenized here
+        if self.query_log is None:
+            return
+        top = self.query_log.most_common(max_queries)
+        token_uses = Counter()
+        for tokens, (_, frequency) in zip(self.utils.tokenize_queries([query for query, _ in top]), top):
+            for token in set(tokens):
+                token_uses[token] += frequency
+        if token_uses:
+            for future in [executor.submit(_shard_warm, token_uses) for executor in self.executors]:
+                future.result()
+
+
+    async def _scatter(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[loop.run_in_executor(executor, fn, *args) for executor in self.executors])
+
+
+    async def _search_tokens(self, query, tokens, k, retrieval):
+        if len(query) > 1 and query.startswith('"') and query.endswith('"'):
+            retrieval = 'phrase'
+        key = (tuple(tokens), k, retrieval)
+        response = self.result_cache.get(key, MISSING)
+        if response is MISSING:
+            response = await self._search_shards(query, tokens, k, retrieval)
+            self.result_cache.put(key, response)
+        return response
+
+
+    async def _search_shards(self, query, tokens, k, retrieval):
+        stats = self.stats.subset(tokens)
+        if self.rerank_depth is None:
+            responses = await self._scatter(_shard_search, query, tokens, k, retrieval, stats)
+            return merge_shards(responses, k, self.scorer)
+        # Two rounds, so that the candidates to rerank are picked as in a single index:
+        # the shards' first stage bounds are merged, and every shard selects its best
+        # by first stage score on that common scale
+        shard_bounds = await self._scatter(_shard_bounds, query, tokens, k, retrieval, stats)
+        shard_bounds = [bounds[0] for bounds in shard_bounds if bounds is not None]
+        if not shard_bounds:
+            return
+        responses = await self._scatter(_shard_search, query, tokens, k, retrieval, stats,
+                                        self.scorer.merge_bounds(shard_bounds))
+        return merge_shards(responses, k, self.scorer, self.rerank_depth)
+
+
+    async def search(self, query, k=20, retrieval='all'):
+        if self.query_log is not None:
+            self.query_log.append([query])
+        loop = asyncio.get_running_loop()
+        tokens = await loop.run_in_executor(self.tokenizer, self.utils.tokenize_query, query)
+        return await self._search_tokens(query, tokens, k, retrieval)
+
+
+    async def search_many(self, queries, k=20, retrieval='all'):
+        if self.query_log is not None:
+            self.query_log.append(queries)
+        loop = asyncio.get_running_loop()
+        token_lists = await loop.run_in_executor(self.tokenizer, self.utils.tokenize_queries, queries)
+        return await asyncio.gather(*[self._search_tokens(query, tokens, k, retrieval)
+                                      for query, tokens in zip(queries, token_lists)])
+
+
+    async def cache_stats(self):
+        return {'results': self.result_cache.stats(), 'shards': await self._scatter(_cache_stats)}
+
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
+        self.tokenizer.shutdown()
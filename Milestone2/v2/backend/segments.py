@@ -0,0 +1,727 @@
+import heapq
+import math
+import os
+import shutil
+import threading
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from json import load as jload, dump as jdump
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from cache import LFUCache
+from postings import PostingList, FIELDS
+from disk_index import (DiskIndex, IndexWriter, META_FILE, TERMS_IDX, TERMS_DAT, POSTINGS_DAT,
+                        DOCS_IDX, DOCS_DAT, DOCS_LEN, DOCS_NORM, DOCS_FIELDS, _map)
+from term_stats import TermStats, TermStatsTable, doc_totals, write_term_stats, load_term_stats
+
+
+# A segmented index directory holds immutable segments (each a regular on-disk index
+# in its own subdirectory), the documents deleted from them, and the statistics the
+# scorer needs over all of them. segments.json is replaced atomically on every commit;
+# every other file it names is written once under a new generation number.
+MANIFEST_FILE = 'segments.json'
+SEGMENT_FILES = (META_FILE, TERMS_IDX, TERMS_DAT, POSTINGS_DAT, DOCS_IDX, DOCS_DAT, DOCS_LEN, DOCS_NORM,
+                 DOCS_FIELDS)
+# Files written under a new generation number by every commit
+GENERATION_PREFIXES = ('seg_', 'norms_', 'sums_', 'stats_', 'pages_')
+# In each segment: the term ordinals (positions in the segment's term dictionary) of
+# every document, so that a commit finds the terms of deleted documents without
+# reading postings. num_docs + 1 uint64 offsets, then the uint32 ordinals.
+DOC_TERMS = 'doc_terms.dat'
+# Columns of a commit's per-document sums: 1 for a live document, then the sums over
+# its terms of tf^2, tf^2 * idf and (tf * idf)^2, its squared norm
+SUM_COLUMNS = 4
+# Locked by whichever process is updating, merging or rebuilding the index
+LOCK_FILE = 'write.lock'
+MAX_SEGMENTS = 8
+# Threads reading one term's postings from several segments at once
+FETCH_THREADS = 4
+# Attempts at opening an index while writers replace its files
+OPEN_ATTEMPTS = 5
+
+_fetch_pool = None
+
+
+def _fetch_executor():
+    global _fetch_pool
+    if _fetch_pool is None:
+        _fetch_pool = ThreadPoolExecutor(FETCH_THREADS)
+    return _fetch_pool
+
+
+def is_segmented(index_dir):
+    return os.path.isfile(os.path.join(index_dir, MANIFEST_FILE))
+
+
+def _write_json(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        jdump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(index_dir):
+    # pages: loc -> [global doc id or None for a page without text, url, page digest]
+    with open(os.path.join(index_dir, MANIFEST_FILE), 'r') as f:
+        manifest = jload(f)
+    with open(os.path.join(index_dir, manifest['pages']), 'r') as f:
+        pages = jload(f)
+    return manifest, pages
+
+
+def open_index(index_dir, cache_bytes=0):
+    # The segmented or plain index in index_dir. Readers take no lock: a commit keeps
+    # the files of the manifest before it, but further commits or a full rebuild can
+    # remove them before a slow reader has opened them all, and the next attempt opens
+    # the newer index instead.
+    for attempt in range(OPEN_ATTEMPTS):
+        try:
+            if is_segmented(index_dir):
+                return SegmentedIndex(index_dir, cache_bytes)
+            return DiskIndex(index_dir, cache_bytes)
+        except FileNotFoundError:
+            if attempt == OPEN_ATTEMPTS - 1:
+                raise
+
+
+def new_segment_name(manifest):
+    return f'seg_{manifest["generation"] + 1}'
+
+
+def _stat_key(index_dir):
+    st = os.stat(os.path.join(index_dir, MANIFEST_FILE))
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _segment_docs(manifest):
+    return sum(segment['num_docs'] for segment in manifest['segments'])
+
+
+def write_doc_terms(segment_dir, num_docs, doc_lists):
+    # doc_lists: local doc ids of each term's postings, in term dictionary order
+    doc_ids = np.concatenate(doc_lists).astype(np.int64) if doc_lists else np.zeros(0, dtype=np.int64)
+    ordinals = np.repeat(np.arange(len(doc_lists), dtype=np.uint32), [len(d) for d in doc_lists])
+    offsets = np.zeros(num_docs + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum(np.bincount(doc_ids, minlength=num_docs))
+    with open(os.path.join(segment_dir, DOC_TERMS), 'wb') as f:
+        f.write(offsets.tobytes())
+        f.write(ordinals[np.argsort(doc_ids, kind='stable')].tobytes())
+
+
+def _doc_terms(segment, segment_dir, doc_ids):
+    # Terms of the segment's documents at the local doc_ids
+    buf = _map(os.path.join(segment_dir, DOC_TERMS))
+    offsets = np.frombuffer(buf, dtype=np.uint64, count=len(segment.docs) + 1)
+    ordinals = np.frombuffer(buf, dtype=np.uint32, offset=offsets.nbytes)
+    terms = set()
+    for doc_id in doc_ids.tolist():
+        for ordinal in ordinals[offsets[doc_id]:offsets[doc_id + 1]].tolist():
+            terms.add(segment._term(segment._entry(ordinal)).decode('utf-8'))
+    return terms
+
+
+def _read_sums(path):
+    return np.frombuffer(_map(path), dtype=np.float64).reshape(-1, SUM_COLUMNS)
+
+
+class SegmentedDocTable():
+
+    def __init__(self, segments, bases, norms):
+        self.tables = [segment.docs for segment in segments]
+        self.bases = bases
+        self.lengths = array('I')
+        self.field_lengths = array('I')
+        for table in self.tables:
+            self.lengths.extend(table.lengths)
+            self.field_lengths.extend(table.field_lengths)
+        # Norms are kept for the whole index, the segments' own norms go stale as it grows
+        self.norms = norms
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, doc_id):
+        if not 0 <= doc_id < len(self.lengths):
+            raise IndexError(doc_id)
+        s = bisect_right(self.bases, doc_id) - 1
+        return self.tables[s][doc_id - self.bases[s]]
+
+    def length(self, doc_id):
+        return self.lengths[doc_id]
+
+    def field_length(self, doc_id):
+        return self.field_lengths[doc_id * len(FIELDS):(doc_id + 1) * len(FIELDS)].tolist()
+
+
+class SegmentedIndex():
+
+    def __init__(self, index_dir, cache_bytes=0, manifest=None):
+        # manifest: read a manifest that is not committed yet (used while updating)
+        self.index_dir = index_dir
+        self.manifest_stat = None
+        if manifest is None:
+            self.manifest_stat = _stat_key(index_dir)
+            manifest, _ = load_manifest(index_dir)
+        self.meta = manifest
+        self.num_documents = manifest['num_documents']
+
+        self.segments = [DiskIndex(os.path.join(index_dir, segment['name'])) for segment in manifest['segments']]
+        self.bases = [segment['base'] for segment in manifest['segments']]
+        self.deleted = np.array(sorted(manifest['deleted']), dtype=np.uint32)
+        norms = _map(os.path.join(index_dir, manifest['norms'])) if manifest['norms'] else b''
+        self.docs = SegmentedDocTable(self.segments, self.bases, memoryview(norms).cast('d'))
+        self.cache = LFUCache(cache_bytes) if cache_bytes > 0 else None
+        # Statistics of the live documents, written by commit; without them (while
+        # committing) document frequencies are counted from the live postings
+        if manifest.get('stats'):
+            self.stats = load_term_stats(os.path.join(index_dir, manifest['stats']))
+        else:
+            self.stats = TermStats(self.num_documents, *doc_totals(self.docs, self.deleted), self._live_doc_freq)
+
+
+    def _read(self, token, segments=None):
+        # Live postings of token over the segments (all by default) with global doc ids.
+        # Postings store no idf, the scorer takes idfs from self.stats. A segment's impact order was computed
+        # with the norms it was built with, which every commit replaces, so it is
+        # dropped and impact retrieval orders the postings by the current norms.
+        segments = range(len(self.segments)) if segments is None else segments
+        if len(segments) > 1:
+            fetched = _fetch_executor().map(lambda s: self.segments[s].get(token), segments)
+        else:
+            fetched = [self.segments[s].get(token) for s in segments]
+        parts = [(self.bases[s], postings) for s, postings in zip(segments, fetched) if postings is not None]
+        if not parts:
+            return None
+
+        if len(parts) == 1 and parts[0][0] == 0:
+            merged = parts[0][1]
+        else:
+            merged = PostingList()
+            for base, postings in parts:
+                merged.extend(postings, base)
+
+        doc_ids = np.frombuffer(merged.doc_ids, dtype=np.uint32)
+        if len(self.deleted):
+            live = np.nonzero(~np.isin(doc_ids, self.deleted))[0]
+            if not len(live):
+                return None
+            if len(live) < len(doc_ids):
+                merged = merged.select(live.tolist(), doc_ids[live].tolist())
+        merged.impacts = None
+        return merged
+
+
+    def is_stale(self):
+        # True once a newer manifest has been committed (every commit replaces the file),
+        # or once a full rebuild has replaced the segments with a plain index
+        if self.manifest_stat is None:
+            return False
+        try:
+            return _stat_key(self.index_dir) != self.manifest_stat
+        except FileNotFoundError:
+            return True
+
+
+    def _lookup(self, token):
+        if self.cache is not None:
+            postings = self.cache.get(token)
+            if postings is not None:
+                return postings
+        postings = self._read(token)
+        if postings is not None and self.cache is not None:
+            self.cache.put(token, postings, postings.nbytes())
+        return postings
+
+
+    def warm(self, token_uses):
+        if self.cache is None:
+            return 0
+        loaded = 0
+        for token, uses in sorted(token_uses.items(), key=lambda x: -x[1]):
+            if token in self.cache:
+                continue
+            postings = self._read(token)
+            if postings is None:
+                continue
+            if self.cache.used + postings.nbytes() > self.cache.max_bytes:
+                break
+            self.cache.put(token, postings, postings.nbytes(), uses)
+            loaded += 1
+        return loaded
+
+
+    def __len__(self):
+        return self.meta['unique_words']
+
+
+    def __contains__(self, token):
+        return self._lookup(token) is not None
+
+
+    def __getitem__(self, token):
+        postings = self._lookup(token)
+        if postings is None:
+            raise KeyError(token)
+        return postings
+
+
+    def get(self, token, default=None):
+        postings = self._lookup(token)
+        if postings is None:
+            return default
+        return postings
+
+
+    def get_blocks(self, token, probes):
+        # A segment's packed postings need no merging only while it is the sole
+        # segment and has no deleted documents
+        if len(self.segments) == 1 and not len(self.deleted) and not (self.cache is not None and token in self.cache):
+            return self.segments[0].get_blocks(token, probes)
+        return self.get(token)
+
+
+    def doc_freq(self, token):
+        return self.stats.doc_freq(token) or 0
+
+
+    def _live_doc_freq(self, token):
+        # Deleted documents no longer count, so the df is taken from the live postings
+        postings = self._lookup(token)
+        return len(postings) if postings is not None else 0
+
+
+    def keys(self, segments=None):
+        segments = range(len(self.segments)) if segments is None else segments
+        terms = heapq.merge(*[(token.encode('utf-8') for token in self.segments[s].keys()) for s in segments])
+        last = None
+        for token_b in terms:
+            if token_b != last:
+                last = token_b
+                yield token_b.decode('utf-8')
+
+
+    def items(self):
+        for token in self.keys():
+            postings = self._read(token)
+            if postings is not None:
+                yield token, postings
+
+
+    def values(self):
+        for _, postings in self.items():
+            yield postings
+
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(self.index_dir) for name in names)
+
+
+def migrate_index(index_dir, pages):
+    # Turns a plain on-disk index into the first segment of a segmented index.
+    # pages: loc -> [doc id, url, page digest] for the indexed documents.
+    # The files are linked (or copied) rather than moved, since a running server
+    # may still map them; it switches to the segments on its next refresh, and the
+    # old files are removed once nothing maps them.
+    segment_dir = os.path.join(index_dir, 'seg_0')
+    os.makedirs(segment_dir)
+    for name in SEGMENT_FILES:
+        try:
+            os.link(os.path.join(index_dir, name), os.path.join(segment_dir, name))
+        except OSError:
+            shutil.copyfile(os.path.join(index_dir, name), os.path.join(segment_dir, name))
+
+    with open(os.path.join(segment_dir, META_FILE), 'r') as f:
+        meta = jload(f)
+    manifest = {'generation': 0,
+                'num_documents': meta['num_documents'],
+                'unique_words': meta['unique_words'],
+                'segments': [{'name': 'seg_0', 'base': 0, 'num_docs': meta['num_docs_stored']}],
+                'deleted': [],
+                'norms': None,
+                'sums': None,
+                'stats': None,
+                'pages': None}
+    return commit(index_dir, manifest, pages)
+
+
+def add_segment(manifest, name, num_docs, deleted, num_documents):
+    # Appends the delta segment written to new_segment_name(manifest), if any, and
+    # tombstones the replaced and removed documents
+    manifest = dict(manifest)
+    if name is not None:
+        manifest['generation'] += 1
+        manifest['segments'] = manifest['segments'] + [{'name': name, 'base': _segment_docs(manifest),
+                                                        'num_docs': num_docs}]
+    manifest['deleted'] = sorted(set(manifest['deleted']) | set(deleted))
+    manifest['num_documents'] = num_documents
+    return manifest
+
+
+def merge_segments(index_dir, manifest, pages, start, stop, order=None):
+    # Rewrites segments [start, stop) as one segment without their deleted documents.
+    # order: sort key of a global doc id giving the merged segment's document order
+    # (by default the current order). Later doc ids shift down by the dropped documents.
+    index = SegmentedIndex(index_dir, manifest=manifest)
+    lo = index.bases[start]
+    hi = index.bases[stop] if stop < len(index.bases) else len(index.docs)
+    deleted = set(manifest['deleted'])
+    live = [doc_id for doc_id in range(lo, hi) if doc_id not in deleted]
+    if order is not None:
+        live.sort(key=order)
+    remap = np.full(hi - lo, -1, dtype=np.int64)
+    remap[np.array(live, dtype=np.int64) - lo] = np.arange(len(live))
+
+    manifest = dict(manifest)
+    name = new_segment_name(manifest)
+    manifest['generation'] += 1
+    if manifest.get('sums'):
+        # The last commit's sums follow their documents, so the commit after the merge,
+        # which adds and deletes none, reads no postings
+        sums = _read_sums(os.path.join(index_dir, manifest['sums']))
+        manifest['sums'] = None
+        if len(sums) == len(index.docs):
+            sums = np.concatenate([sums[:lo], sums[np.array(live, dtype=np.int64)], sums[hi:]])
+            manifest['sums'] = f'sums_{manifest["generation"]}.dat'
+            with open(os.path.join(index_dir, manifest['sums']), 'wb') as f:
+                f.write(sums.tobytes())
+    if live:
+        writer = IndexWriter(os.path.join(index_dir, name))
+        for doc_id in live:
+            loc, url, title = index.docs[doc_id]
+            writer.add_document(loc, url, title, index.docs.length(doc_id), index.docs.field_length(doc_id))
+        segments = range(start, stop)
+        doc_lists = []
+        for token in index.keys(segments):
+            postings = index._read(token, segments)
+            if postings is None:
+                continue
+            new_ids = remap[np.frombuffer(postings.doc_ids, dtype=np.uint32) - lo]
+            ranked = np.argsort(new_ids, kind='stable')
+            writer.add_term(token, postings.select(ranked.tolist(), new_ids[ranked].tolist()))
+            doc_lists.append(new_ids[ranked])
+        # A segment's own norms are never read: the manifest's norms cover the whole index
+        writer.close(manifest['num_documents'], [0.0] * len(live))
+        write_doc_terms(os.path.join(index_dir, name), len(live), doc_lists)
+
+    shift = (hi - lo) - len(live)
+
+    def _renumber(doc_id):
+        if doc_id < lo:
+            return doc_id
+        if doc_id >= hi:
+            return doc_id - shift
+        return lo + int(remap[doc_id - lo]) if remap[doc_id - lo] >= 0 else None
+
+    merged = [{'name': name, 'base': lo, 'num_docs': len(live)}] if live else []
+    rest = [dict(segment, base=segment['base'] - shift) for segment in manifest['segments'][stop:]]
+    manifest['segments'] = manifest['segments'][:start] + merged + rest
+    manifest['deleted'] = [_renumber(doc_id) for doc_id in manifest['deleted'] if not lo <= doc_id < hi]
+    pages = {loc: [_renumber(doc_id) if doc_id is not None else None, url, digest]
+             for loc, (doc_id, url, digest) in pages.items()}
+    return manifest, pages
+
+
+def commit(index_dir, manifest, pages):
+    # Updates the term statistics and document norms for the documents added and
+    # deleted since the last commit (no page is re-tokenized), then publishes the new
+    # manifest. Only the postings of the terms of those documents are read, unless
+    # the last commit's sums are missing (e.g. after a migration).
+    manifest = dict(manifest)
+    manifest['generation'] += 1
+    index = SegmentedIndex(index_dir, manifest=dict(manifest, norms=None, stats=None))
+    for segment, entry in zip(index.segments, manifest['segments']):
+        segment_dir = os.path.join(index_dir, entry['name'])
+        if not os.path.isfile(os.path.join(segment_dir, DOC_TERMS)):
+            write_doc_terms(segment_dir, entry['num_docs'],
+                            [np.frombuffer(postings.doc_ids, dtype=np.uint32) for postings in segment.values()])
+    if manifest.get('sums') and manifest.get('stats'):
+        sums, doc_freqs = _update_sums(index_dir, index, manifest)
+    else:
+        sums, doc_freqs = _count_sums(index, manifest['num_documents'])
+
+    manifest['sums'] = f'sums_{manifest["generation"]}.dat'
+    with open(os.path.join(index_dir, manifest['sums']), 'wb') as f:
+        f.write(sums.tobytes())
+    manifest['norms'] = f'norms_{manifest["generation"]}.dat'
+    with open(os.path.join(index_dir, manifest['norms']), 'wb') as f:
+        # Taking back a term's old weights may leave a zero norm slightly negative
+        f.write(np.sqrt(np.maximum(sums[:, 3], 0)).tobytes())
+    manifest['stats'] = f'stats_{manifest["generation"]}'
+    write_term_stats(os.path.join(index_dir, manifest['stats']), manifest['num_documents'],
+                     index.stats.num_docs, index.stats.total_length, index.stats.field_lengths, doc_freqs)
+    manifest['unique_words'] = len(doc_freqs)
+    manifest['pages'] = f'pages_{manifest["generation"]}.json'
+    with open(os.path.join(index_dir, manifest['pages']), 'w') as f:
+        jdump(pages, f)
+
+    previous = None
+    if is_segmented(index_dir):
+        with open(os.path.join(index_dir, MANIFEST_FILE), 'r') as f:
+            previous = jload(f)
+    _write_json(os.path.join(index_dir, MANIFEST_FILE), manifest)
+    _remove_unused(index_dir, manifest, previous)
+    return manifest
+
+
+def _add_sums(sums, doc_ids, tf, idf, last_idf=None):
+    # Adds a term's weights with idf to the sums of the documents doc_ids; with
+    # last_idf, replaces the term's weights with last_idf instead
+    if last_idf is None:
+        sums[doc_ids, 1] += tf ** 2
+        sums[doc_ids, 2] += tf ** 2 * idf
+        sums[doc_ids, 3] += (tf * idf) ** 2
+    else:
+        sums[doc_ids, 2] += tf ** 2 * (idf - last_idf)
+        sums[doc_ids, 3] += (tf * idf) ** 2 - (tf * last_idf) ** 2
+
+
+def _term_frequencies(index, token, lengths):
+    # Live doc ids and term frequencies of token, read straight from the segments'
+    # columns rather than merged into a PostingList
+    doc_ids, counts = [], []
+    for base, segment in zip(index.bases, index.segments):
+        postings = segment.get(token)
+        if postings is not None:
+            doc_ids.append(np.frombuffer(postings.doc_ids, dtype=np.uint32).astype(np.int64) + base)
+            counts.append(np.frombuffer(postings.counts, dtype=np.uint32))
+    doc_ids = np.concatenate(doc_ids) if doc_ids else np.zeros(0, dtype=np.int64)
+    live = ~np.isin(doc_ids, index.deleted)
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.uint32)
+    return doc_ids[live], counts[live] / lengths[doc_ids[live]]
+
+
+def _count_sums(index, num_documents):
+    # Sums over the live postings of every term, in term byte order like a full build
+    lengths = np.frombuffer(index.docs.lengths, dtype=np.uint32)
+    sums = np.zeros((len(index.docs), SUM_COLUMNS))
+    sums[:, 0] = 1
+    sums[index.deleted] = 0
+    doc_freqs = {}
+    for token in index.keys():
+        doc_ids, tf = _term_frequencies(index, token, lengths)
+        if len(doc_ids):
+            doc_freqs[token] = len(doc_ids)
+            _add_sums(sums, doc_ids, tf, math.log(num_documents / len(doc_ids)))
+    return sums, doc_freqs
+
+
+def _update_sums(index_dir, index, manifest):
+    # The last commit's sums with the documents added since: the terms whose df
+    # changed are those of the added and the newly deleted documents, and only the
+    # weights of these terms are replaced. The change in the number of documents
+    # shifts every idf by the same log ratio, applied to all sums at once.
+    num_documents = manifest['num_documents']
+    last_stats = load_term_stats(os.path.join(index_dir, manifest['stats']))
+    doc_freqs = dict(TermStatsTable(os.path.join(index_dir, manifest['stats'])).doc_freqs())
+    last_sums = _read_sums(os.path.join(index_dir, manifest['sums']))
+    counted = len(last_sums)
+    sums = np.zeros((len(index.docs), SUM_COLUMNS))
+    sums[:counted] = last_sums
+    sums[counted:, 0] = 1
+    # Deleted documents still marked live were deleted since the last commit
+    deleted = index.deleted.astype(np.int64)
+    removed = deleted[sums[deleted, 0] > 0]
+    sums[deleted] = 0
+
+    touched = set()
+    for segment, entry in zip(index.segments, manifest['segments']):
+        lo, hi = entry['base'], entry['base'] + entry['num_docs']
+        if lo >= counted:
+            touched.update(segment.keys())
+            continue
+        local = removed[(removed >= lo) & (removed < hi)] - lo
+        if len(local):
+            touched.update(_doc_terms(segment, os.path.join(index_dir, entry['name']), local))
+
+    shift = math.log(num_documents / last_stats.num_documents)
+    if shift:
+        sums[:, 3] += shift * (2 * sums[:, 2] + shift * sums[:, 1])
+        sums[:, 2] += shift * sums[:, 1]
+
+    lengths = np.frombuffer(index.docs.lengths, dtype=np.uint32)
+    for token in sorted(touched, key=lambda t: t.encode('utf-8')):
+        last_df = doc_freqs.pop(token, 0)
+        doc_ids, tf = _term_frequencies(index, token, lengths)
+        if not len(doc_ids):
+            continue
+        doc_freqs[token] = len(doc_ids)
+        idf = math.log(num_documents / len(doc_ids))
+        added = doc_ids >= counted
+        _add_sums(sums, doc_ids[added], tf[added], idf)
+        if last_df and last_df != len(doc_ids):
+            _add_sums(sums, doc_ids[~added], tf[~added], idf, math.log(num_documents / last_df))
+    return sums, doc_freqs
+
+
+def _generation_files(manifest):
+    return ({segment['name'] for segment in manifest['segments']}
+            | {manifest['norms'], manifest.get('sums'), manifest['stats'], manifest['pages']})
+
+
+def _remove_unused(index_dir, manifest, previous=None):
+    # The files of the previous manifest stay for readers that read it just before
+    # this commit and are still opening them. Files still mapped by a reader of an
+    # older manifest (or, for the files of the plain index it was migrated from, a
+    # reader that has not refreshed yet) may not be removable yet on Windows; they
+    # are retried on the next commit.
+    used = _generation_files(manifest) | (_generation_files(previous) if previous else set())
+    for name in os.listdir(index_dir):
+        if name in used or not (name.startswith(GENERATION_PREFIXES) or name in SEGMENT_FILES):
+            continue
+        _remove(os.path.join(index_dir, name))
+
+
+def _remove(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def remove_segments(index_dir):
+    # Called under the write lock by a full rebuild, once it has written a plain index
+    # into index_dir. Removing the manifest first switches readers over to the plain
+    # index; the segments and every generation's files go after it.
+    if not is_segmented(index_dir):
+        return
+    os.remove(os.path.join(index_dir, MANIFEST_FILE))
+    for name in os.listdir(index_dir):
+        if name.startswith(GENERATION_PREFIXES):
+            _remove(os.path.join(index_dir, name))
+
+
+class IndexLock():
+
+    # Serializes the writers of an index directory (updates, merges and full rebuilds),
+    # including writers in other processes; readers never take it. The lock file stays in place
+    # and is locked by the OS, which releases the lock if its holder crashes.
+    def __init__(self, index_dir):
+        self.path = os.path.join(index_dir, LOCK_FILE)
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            # LK_LOCK gives up after about 10 seconds, so keep waiting
+            while True:
+                try:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        # The holder's pid, for diagnosing a long wait
+        self.file.truncate(0)
+        self.file.write(str(os.getpid()))
+        self.file.flush()
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+
+
+class TieredMergePolicy():
+
+    def __init__(self, merge_factor=4, max_segments=MAX_SEGMENTS, max_deleted=0.5):
+        # Segments are grouped into tiers of similar live size (powers of merge_factor);
+        # merge_factor adjacent segments of one tier are merged together, so each
+        # document is rewritten about log(N) times as the index grows
+        self.merge_factor = merge_factor
+        # Upper bound on segments a query reads from
+        self.max_segments = max_segments
+        # Segments with a larger share of deleted documents are rewritten without them
+        self.max_deleted = max_deleted
+
+
+    def find_merge(self, manifest):
+        # The [start, stop) range of adjacent segments to merge next, or None
+        segments = manifest['segments']
+        deleted = np.array(manifest['deleted'], dtype=np.int64)
+        live = []
+        for segment in segments:
+            lo, hi = segment['base'], segment['base'] + segment['num_docs']
+            live.append(segment['num_docs'] - int(np.count_nonzero((deleted >= lo) & (deleted < hi))))
+
+        for i, segment in enumerate(segments):
+            if segment['num_docs'] and 1 - live[i] / segment['num_docs'] > self.max_deleted:
+                return i, i + 1
+
+        tiers = [int(math.log(max(n, 1), self.merge_factor)) for n in live]
+        best = None
+        for start in range(len(segments) - self.merge_factor + 1):
+            window = tiers[start:start + self.merge_factor]
+            if min(window) == max(window) and (best is None or window[0] < tiers[best]):
+                best = start
+        if best is not None:
+            return best, best + self.merge_factor
+
+        if len(segments) > self.max_segments:
+            start = min(range(len(segments) - 1), key=lambda i: live[i] + live[i + 1])
+            return start, start + 2
+        return None
+
+
+    def merge(self, index_dir):
+        # Runs merges until the policy finds none; each one holds the write lock only
+        # for itself, so updates can interleave. Returns the number of merges run.
+        merges = 0
+        while True:
+            with IndexLock(index_dir):
+                # A full rebuild may have replaced the segments while this one waited
+                if not is_segmented(index_dir):
+                    return merges
+                manifest, pages = load_manifest(index_dir)
+                found = self.find_merge(manifest)
+                if found is None:
+                    return merges
+                manifest, pages = merge_segments(index_dir, manifest, pages, *found)
+                commit(index_dir, manifest, pages)
+            merges += 1
+
+
+class BackgroundMerger():
+
+    def __init__(self, index_dir, policy=None, interval=30):
+        self.index_dir = index_dir
+        self.policy = policy or TieredMergePolicy()
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            if not is_segmented(self.index_dir):
+                continue
+            try:
+                self.policy.merge(self.index_dir)
+            except Exception as e:
+                print(f'Background merge of {self.index_dir} failed: {e}')
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
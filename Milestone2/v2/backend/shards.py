@@ -0,0 +1,54 @@
+import math
+import os
+from collections import Counter
+
+import numpy as np
+from json import dump as jdump
+
+from disk_index import DiskIndex, DOCS_NORM
+from postings import FIELDS
+from term_stats import doc_totals, write_term_stats
+
+
+# A sharded index directory holds one regular on-disk index per shard, each with a
+# contiguous slice of the documents, shards.json naming them and the term statistics
+# of the whole corpus
+SHARDS_FILE = 'shards.json'
+
+
+def is_sharded(index_dir):
+    return os.path.isfile(os.path.join(index_dir, SHARDS_FILE))
+
+
+def write_shards(index_dir, names, num_documents):
+    # Each shard was built with only its own document frequencies. The corpus-wide
+    # ones are written for the front end to parse queries with, and the norms that
+    # the cosine divides by are recomputed with them, so a document scores the same
+    # as in an unsharded index.
+    doc_freqs = Counter()
+    num_docs = total_length = 0
+    field_lengths = [0] * len(FIELDS)
+    for name in names:
+        shard = DiskIndex(os.path.join(index_dir, name))
+        doc_freqs.update(dict(shard.doc_freqs()))
+        shard_docs, shard_length, shard_fields = doc_totals(shard.docs)
+        num_docs += shard_docs
+        total_length += shard_length
+        field_lengths = [total + length for total, length in zip(field_lengths, shard_fields)]
+        del shard
+    write_term_stats(index_dir, num_documents, num_docs, total_length, field_lengths, doc_freqs)
+
+    for name in names:
+        shard = DiskIndex(os.path.join(index_dir, name))
+        lengths = np.frombuffer(shard.docs.lengths, dtype=np.uint32)
+        squares = np.zeros(len(lengths))
+        for token, postings in shard.items():
+            doc_ids = np.frombuffer(postings.doc_ids, dtype=np.uint32)
+            tf = np.frombuffer(postings.counts, dtype=np.uint32) / lengths[doc_ids]
+            squares[doc_ids] += (tf * math.log(num_documents / doc_freqs[token])) ** 2
+        del shard, lengths
+        with open(os.path.join(index_dir, name, DOCS_NORM), 'wb') as f:
+            f.write(np.sqrt(squares).tobytes())
+
+    with open(os.path.join(index_dir, SHARDS_FILE), 'w') as f:
+        jdump({'num_documents': num_documents, 'unique_words': len(doc_freqs), 'shards': names}, f)
@@ -0,0 +1,66 @@
+import heapq
+import mmap
+import os
+import struct
+
+from disk_index import pack_postings, unpack_postings
+from postings import PostingList
+
+
+# term length, document frequency, postings block length
+RUN_ENTRY = struct.Struct('<III')
+
+# Rough in-memory cost of the build structures, used to decide when to flush a run.
+# A document of n tokens adds at most n postings and n encoded positions.
+POSTING_BYTES = 16
+TERM_BYTES = 400
+
+
+def write_run(path, inverted_index):
+    with open(path, 'wb') as f:
+        for token in sorted(inverted_index, key=lambda t: t.encode('utf-8')):
+            postings = inverted_index[token]
+            token_b = token.encode('utf-8')
+            block = pack_postings(postings)
+            f.write(RUN_ENTRY.pack(len(token_b), len(postings), len(block)))
+            f.write(token_b)
+            f.write(block)
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset < len(buf):
+            term_len, df, block_len = RUN_ENTRY.unpack_from(buf, offset)
+            offset += RUN_ENTRY.size
+            token_b = buf[offset:offset + term_len]
+            offset += term_len
+            yield token_b, unpack_postings(buf, offset, df)
+            offset += block_len
+    finally:
+        buf.close()
+
+
+def merge_runs(paths):
+    # Runs hold increasing doc id ranges, so equal terms are concatenated in run order
+    def _keyed(run_idx, path):
+        for token_b, postings in read_run(path):
+            yield token_b, run_idx, postings
+
+    runs = [_keyed(run_idx, path) for run_idx, path in enumerate(paths)]
+    current = None
+    merged = None
+    for token_b, _, postings in heapq.merge(*runs, key=lambda r: (r[0], r[1])):
+        if token_b != current:
+            if current is not None:
+                yield current.decode('utf-8'), merged
+            current = token_b
+            merged = PostingList()
+        merged.extend(postings)
+
+    if current is not None:
+        yield current.decode('utf-8'), merged
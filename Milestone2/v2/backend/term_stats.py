@@ -0,0 +1,112 @@
+import math
+import os
+import struct
+
+import numpy as np
+from json import load as jload, dump as jdump
+
+from disk_index import _map
+from postings import FIELDS
+
+
+# Collection statistics the scorer reads at query time: the number of documents idf
+# is computed over, the number and total length (overall and per field) of the
+# indexed documents, and each term's document frequency. Postings are scored from
+# their term counts with these, so an index that is split into shards or grows by
+# segments only replaces this small table to keep its idfs exact, and never
+# rewrites postings.
+STATS_META = 'stats.json'
+STATS_IDX = 'stats.idx'
+STATS_DAT = 'stats.dat'
+# term offset, term length, document frequency
+STATS_ENTRY = struct.Struct('<QII')
+
+
+class TermStats():
+
+    def __init__(self, num_documents, num_docs, total_length, field_lengths, doc_freq):
+        # field_lengths: total length of each of FIELDS; doc_freq: function of a term
+        # giving its document frequency (0 or None if absent)
+        self.num_documents = num_documents
+        self.num_docs = num_docs
+        self.total_length = total_length
+        self.field_lengths = field_lengths
+        self.avg_doc_length = total_length / num_docs if num_docs else 0.0
+        self.avg_field_lengths = [length / num_docs if num_docs else 0.0 for length in field_lengths]
+        self.doc_freq = doc_freq
+
+    def idf(self, token):
+        dft = self.doc_freq(token)
+        return math.log(self.num_documents / dft) if dft else None
+
+    def subset(self, tokens):
+        # Statistics of only these terms, small enough to send along with a query
+        doc_freqs = {token: self.doc_freq(token) for token in set(tokens)}
+        return TermStats(self.num_documents, self.num_docs, self.total_length, self.field_lengths,
+                         doc_freqs.get)
+
+
+class TermStatsTable():
+
+    def __init__(self, stats_dir):
+        self.stats_idx = _map(os.path.join(stats_dir, STATS_IDX))
+        self.stats_dat = _map(os.path.join(stats_dir, STATS_DAT))
+        self.num_terms = len(self.stats_idx) // STATS_ENTRY.size
+
+    def doc_freq(self, token):
+        token_b = token.encode('utf-8')
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            term_off, term_len, dft = STATS_ENTRY.unpack_from(self.stats_idx, mid * STATS_ENTRY.size)
+            term = self.stats_dat[term_off:term_off + term_len]
+            if term < token_b:
+                lo = mid + 1
+            elif term > token_b:
+                hi = mid
+            else:
+                return dft
+        return 0
+
+    def doc_freqs(self):
+        # (term, df) pairs in term byte order
+        for i in range(self.num_terms):
+            term_off, term_len, dft = STATS_ENTRY.unpack_from(self.stats_idx, i * STATS_ENTRY.size)
+            yield self.stats_dat[term_off:term_off + term_len].decode('utf-8'), dft
+
+
+def doc_totals(docs, deleted=()):
+    # Number of documents, total length and total length of each field of a doc
+    # table, leaving out the deleted doc ids
+    lengths = np.frombuffer(docs.lengths, dtype=np.uint32)
+    field_lengths = np.frombuffer(docs.field_lengths, dtype=np.uint32).reshape(-1, len(FIELDS))
+    deleted = np.asarray(deleted, dtype=np.int64)
+    total_length = int(lengths.sum()) - int(lengths[deleted].sum())
+    field_totals = field_lengths.sum(axis=0) - field_lengths[deleted].sum(axis=0)
+    return len(lengths) - len(deleted), total_length, [int(total) for total in field_totals]
+
+
+def write_term_stats(stats_dir, num_documents, num_docs, total_length, field_lengths, doc_freqs):
+    # doc_freqs: term -> df of every term in the collection
+    os.makedirs(stats_dir, exist_ok=True)
+    with open(os.path.join(stats_dir, STATS_IDX), 'wb') as idx, open(os.path.join(stats_dir, STATS_DAT), 'wb') as dat:
+        for token in sorted(doc_freqs, key=lambda t: t.encode('utf-8')):
+            token_b = token.encode('utf-8')
+            idx.write(STATS_ENTRY.pack(dat.tell(), len(token_b), doc_freqs[token]))
+            dat.write(token_b)
+
+    meta = {'num_documents': num_documents,
+            'num_docs': num_docs,
+            'total_length': total_length,
+            'field_lengths': field_lengths,
+            'unique_words': len(doc_freqs)}
+    with open(os.path.join(stats_dir, STATS_META), 'w') as f:
+        jdump(meta, f)
+
+
+def load_term_stats(stats_dir):
+    with open(os.path.join(stats_dir, STATS_META), 'r') as f:
+        meta = jload(f)
+    table = TermStatsTable(stats_dir)
+    return TermStats(meta['num_documents'], meta['num_docs'], meta['total_length'], meta['field_lengths'],
+                     table.doc_freq)
@@ -0,0 +1,126 @@
+import random
+from array import array
+from bisect import bisect_left
+
+from codec import encode_varbyte, decode_varbyte, encode_gaps, decode_gaps
+from disk_index import SKIP_BLOCK, BlockPostings, pack_postings, unpack_postings
+from postings import PostingList, FIELDS
+
+# usage: python -m pytest test_codec.py
+
+
+def test_varbyte_round_trip():
+    # Every byte length up to the largest uint32, including the 7 bit boundaries
+    values = [0, 1, 127, 128, 255, 16383, 16384, 2 ** 21 - 1, 2 ** 21, 2 ** 28, 2 ** 32 - 1]
+    buf = encode_varbyte(values, bytearray(b'head'))
+    decoded, offset = decode_varbyte(buf, 4, len(values))
+    assert decoded == array('I', values)
+    assert offset == len(buf)
+
+
+def test_gaps_round_trip():
+    rng = random.Random(0)
+    values = sorted(rng.sample(range(2 ** 32), 1000))
+    buf = encode_gaps(values, bytearray())
+    decoded, offset = decode_gaps(buf, 0, len(values))
+    assert decoded == array('I', values)
+    assert offset == len(buf)
+
+
+def test_gaps_small_gaps_take_one_byte():
+    values = list(range(0, 127 * 50, 127))
+    assert len(encode_gaps(values, bytearray())) == len(values)
+
+
+def test_consecutive_blocks():
+    # Blocks are read back to back from one buffer, each from where the last ended
+    buf = bytearray()
+    encode_gaps([3, 9, 300], buf)
+    encode_varbyte([70000, 1], buf)
+    doc_ids, offset = decode_gaps(buf, 0, 3)
+    counts, offset = decode_varbyte(buf, offset, 2)
+    assert list(doc_ids) == [3, 9, 300]
+    assert list(counts) == [70000, 1]
+    assert offset == len(buf)
+
+
+def _random_postings(rng, n):
+    postings = PostingList()
+    doc_ids = sorted(rng.sample(range(100000), n))
+    for doc_id in doc_ids:
+        count = rng.randint(1, 20)
+        idx_list = sorted(rng.sample(range(5000), count))
+        field_counts = [rng.randint(0, 300) for _ in FIELDS] if rng.random() < 0.5 else None
+        postings.append(doc_id, count, idx_list, rng.random() < 0.3, field_counts=field_counts)
+    return postings
+
+
+def _assert_same_postings(decoded, postings):
+    assert decoded.doc_ids == postings.doc_ids
+    assert decoded.counts == postings.counts
+    assert decoded.tags == postings.tags
+    assert decoded.fields == postings.fields
+    assert list(decoded.offsets) == list(postings.offsets)
+    for i in range(len(postings)):
+        assert decoded.idx_list(i) == postings.idx_list(i)
+
+
+def test_pack_postings_round_trip():
+    rng = random.Random(1)
+    postings = _random_postings(rng, 200)
+    block = b'xx' + pack_postings(postings)
+    _assert_same_postings(unpack_postings(block, 2, len(postings)), postings)
+    # Field counts are capped to fit a byte
+    assert max(postings.fields) == 255
+
+
+def test_pack_postings_with_impacts():
+    rng = random.Random(2)
+    postings = _random_postings(rng, 50)
+    impacts = array('I', rng.sample(range(50), 50))
+    decoded = unpack_postings(pack_postings(postings, impacts), 0, len(postings), impact_ordered=True)
+    _assert_same_postings(decoded, postings)
+    assert decoded.impacts == impacts
+
+
+def test_pack_selected_postings():
+    # A selection (as segment merges write) keeps each posting's positions
+    rng = random.Random(3)
+    postings = _random_postings(rng, 100)
+    indices = sorted(rng.sample(range(100), 40))
+    selected = postings.select(indices, [i * 2 for i in range(40)])
+    decoded = unpack_postings(pack_postings(selected), 0, len(selected))
+    assert list(decoded.doc_ids) == [i * 2 for i in range(40)]
+    for i, j in enumerate(indices):
+        assert decoded.idx_list(i) == postings.idx_list(j)
+        assert decoded.counts[i] == postings.counts[j]
+
+
+def test_pack_postings_in_skip_blocks():
+    # Longer lists are stored in skip blocks, the last one partial
+    rng = random.Random(4)
+    for n in (SKIP_BLOCK, SKIP_BLOCK + 1, 3 * SKIP_BLOCK + 50):
+        postings = _random_postings(rng, n)
+        _assert_same_postings(unpack_postings(b'x' + pack_postings(postings), 1, n), postings)
+
+
+def test_block_postings():
+    # Galloping, positions and selections of packed postings against the decoded list
+    rng = random.Random(5)
+    postings = _random_postings(rng, 5 * SKIP_BLOCK + 7)
+    blocks = BlockPostings(b'x' + pack_postings(postings), 1, len(postings))
+    assert list(blocks.doc_ids) == list(postings.doc_ids)
+    for target in rng.sample(range(100001), 300):
+        lo = rng.randint(0, len(postings))
+        expected = max(lo, bisect_left(postings.doc_ids, target))
+        assert blocks.doc_ids.gallop(target, lo) == expected
+    # Only the skip blocks galloped to are decoded
+    blocks = BlockPostings(b'x' + pack_postings(postings), 1, len(postings))
+    assert blocks.doc_ids.gallop(postings.doc_ids[3 * SKIP_BLOCK + 5]) == 3 * SKIP_BLOCK + 5
+    assert list(blocks.blocks) == [3]
+
+    indices = sorted(rng.sample(range(len(postings)), 60))
+    for i in indices:
+        assert blocks.idx_list(i) == postings.idx_list(i)
+    doc_ids = [i * 2 for i in range(60)]
+    _assert_same_postings(blocks.select(indices, doc_ids), postings.select(indices, doc_ids))
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+# Ordering and error handling of the ingestion pipeline
+# usage: python -m pytest test_pipeline.py
+
+
+def _run(stages, source, queue_size=4):
+    # Runs the pipeline on a thread, so a hang fails the test instead of blocking it
+    results = []
+    errors = []
+
+    def _target():
+        try:
+            Pipeline(stages, queue_size).run(source, results.append)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=_target, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), 'pipeline did not finish'
+    return results, errors
+
+
+def test_results_keep_source_order():
+    stages = [Stage('double', lambda items: [item * 2 for item in items], workers=3),
+              Stage('odd', lambda items: [item if item % 4 else None for item in items], workers=2, batch_size=5)]
+    results, errors = _run(stages, range(1000))
+    assert not errors
+    assert results == [item * 2 for item in range(1000) if item * 2 % 4]
+
+
+def test_worker_state():
+    stages = [Stage('add', lambda state, items: [item + state for item in items], workers=2, init=lambda i: 100)]
+    results, errors = _run(stages, range(10))
+    assert results == list(range(100, 110))
+
+
+def test_stage_error_is_raised():
+    def _fail(items):
+        if 50 in items:
+            raise ValueError('bad item')
+        return items
+    results, errors = _run([Stage('fail', _fail, workers=2), Stage('copy', lambda items: items)], range(1000))
+    assert len(errors) == 1 and str(errors[0]) == 'bad item'
+
+
+@pytest.mark.parametrize('failing', [0, 1])
+def test_init_error_is_raised(failing):
+    # A worker whose state cannot be made (e.g. a missing spaCy model) fails the run
+    def _init(i):
+        if i == failing:
+            raise OSError('no model')
+        return 0
+    stages = [Stage('read', lambda items: items, workers=2),
+              Stage('tokenize', lambda state, items: items, workers=2, init=_init)]
+    results, errors = _run(stages, range(1000))
+    assert len(errors) == 1 and isinstance(errors[0], OSError)
+
+
+def test_every_init_failing():
+    stages = [Stage('read', lambda items: items),
+              Stage('tokenize', lambda state, items: items, workers=3, init=lambda i: 1 / 0)]
+    results, errors = _run(stages, range(1000), queue_size=2)
+    assert results == []
+    assert len(errors) == 1 and isinstance(errors[0], ZeroDivisionError)
@@ -0,0 +1,119 @@
+import random
+
+import numpy as np
+import pytest
+
+from disk_index import BlockPostings, pack_postings
+from postings import PostingList
+from retrieval import WINDOW, gallop, intersect, phrase_match, wand_top_k, impact_top_k
+
+# Pruned retrieval against brute force scoring of every matching document
+# usage: python -m pytest test_retrieval.py
+
+
+def _random_lists(rng, num_docs, num_terms):
+    # Posting lists of mixed density: some cover most documents, some only a few
+    lengths = rng.integers(1, 60, num_docs).astype(np.uint32)
+    lists = []
+    for _ in range(num_terms):
+        df = int(rng.integers(1, num_docs + 1)) if rng.random() < 0.5 else int(rng.integers(1, 40))
+        postings = PostingList()
+        for doc_id in np.sort(rng.choice(num_docs, min(df, num_docs), replace=False)).tolist():
+            postings.append(doc_id, int(rng.integers(1, lengths[doc_id] + 1)), [0])
+        lists.append(postings)
+    return lists, lengths
+
+
+def _brute_force(lists, weights, lengths, k, norms=None):
+    # Sorted scores of the k best documents
+    scores = {}
+    for postings, weight in zip(lists, weights):
+        for doc_id, count in zip(postings.doc_ids, postings.counts):
+            score = weight * (count / lengths[doc_id])
+            if norms is not None:
+                score = score / norms[doc_id] if norms[doc_id] > 0 else 0.0
+            scores[doc_id] = scores.get(doc_id, 0) + score
+    return sorted(scores.values(), reverse=True)[:k], scores
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_wand_top_k_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    # Enough documents for several windows of doc ids
+    lists, lengths = _random_lists(rng, int(rng.integers(1, 4 * WINDOW)), int(rng.integers(1, 5)))
+    weights = [float(rng.choice([0, 0.3, 1.7, 4.2])) for _ in lists]
+    k = int(rng.integers(1, 200))
+
+    expected, scores = _brute_force(lists, weights, lengths, k)
+    doc_ids = wand_top_k(lists, weights, lengths, k).tolist()
+    assert doc_ids == sorted(set(doc_ids))
+    assert np.allclose(sorted((scores[d] for d in doc_ids), reverse=True), expected, rtol=1e-12, atol=0)
+
+
+def test_wand_top_k_breaks_ties_by_doc_id():
+    # Equal scores in every window: the lowest doc ids win, as in doc id order
+    lengths = np.full(3 * WINDOW, 10, dtype=np.uint32)
+    lists = []
+    for _ in range(2):
+        postings = PostingList()
+        for doc_id in range(3 * WINDOW):
+            postings.append(doc_id, 2, [0])
+        lists.append(postings)
+    assert wand_top_k(lists, [1.0, 2.0], lengths, 5).tolist() == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_impact_top_k_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    num_docs = int(rng.integers(1, 3000))
+    lists, lengths = _random_lists(rng, num_docs, int(rng.integers(1, 5)))
+    weights = [float(rng.choice([0.3, 1.7, 4.2])) for _ in lists]
+    norms = rng.random(num_docs) * (rng.random(num_docs) > 0.05)
+    k = int(rng.integers(1, 100))
+
+    expected, scores = _brute_force(lists, weights, lengths, k, norms)
+    doc_ids = impact_top_k(lists, weights, lengths, norms, k).tolist()
+    assert doc_ids == sorted(set(doc_ids))
+    assert np.allclose(sorted((scores[d] for d in doc_ids), reverse=True), expected, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_intersect_matches_sets(seed):
+    rng = random.Random(seed)
+    universe = rng.randint(1, 5000)
+    doc_lists = [sorted(rng.sample(range(universe), rng.randint(0, universe)))
+                 for _ in range(rng.randint(1, 4))]
+
+    doc_ids, rows = intersect(doc_lists)
+    assert doc_ids == sorted(set.intersection(*map(set, doc_lists)))
+    for doc_list, row in zip(doc_lists, rows):
+        assert [doc_list[i] for i in row] == doc_ids
+
+
+def test_intersect_skip_blocks():
+    # Packed lists gallop through their skip entries to the same matches
+    rng = random.Random(0)
+    doc_lists = [sorted(rng.sample(range(20000), df)) for df in (200, 2000, 9000)]
+    packed = []
+    for doc_list in doc_lists:
+        postings = PostingList()
+        for doc_id in doc_list:
+            postings.append(doc_id, 1, [0])
+        packed.append(BlockPostings(pack_postings(postings), 0, len(postings)).doc_ids)
+    assert intersect(packed) == intersect(doc_lists)
+    assert intersect(doc_lists[:1] + packed[1:]) == intersect(doc_lists)
+
+
+def test_gallop():
+    values = list(range(0, 1000, 3))
+    for target in range(-1, 1002):
+        for lo in (0, 5, 200):
+            expected = max(lo, next((i for i, v in enumerate(values) if v >= target), len(values)))
+            assert gallop(values, target, lo) == expected
+
+
+def test_phrase_match():
+    assert phrase_match([[1, 7, 20], [3, 8], [9, 30]])
+    assert not phrase_match([[1, 7, 20], [3, 8], [10, 30]])
+    assert phrase_match([[4]])
+    assert not phrase_match([[], [1]])
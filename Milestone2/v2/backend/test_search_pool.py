@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+import random
+
+import pytest
+
+from index import Indexer
+from search import SearchEngine
+from search_pool import ShardedSearchPool
+from token_utils import TokenUtils
+
+# A sharded index against a single index of the same pages
+# usage: python -m pytest test_search_pool.py
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'theta']
+
+
+def _pages(num_pages, seed=0):
+    # Random texts with some words in bold, whose tag and proximity scores reorder
+    # the first stage ranking
+    rng = random.Random(seed)
+    pages = {}
+    for i in range(num_pages):
+        words = [rng.choice(WORDS[:rng.randint(2, len(WORDS))]) for _ in range(rng.randint(1, 12))]
+        words = [f'<b>{word}</b>' if rng.random() < 0.15 else word for word in words]
+        pages[f'{i // 10}/{i % 10}'] = ' '.join(words)
+    return pages
+
+
+QUERIES = ['alpha', 'beta', 'alpha beta', 'beta alpha gamma', 'delta alpha', 'theta', 'omega', '"alpha beta"']
+MODES = ['all', 'and']
+
+
+@pytest.fixture(scope='module', autouse=True)
+def spacy_model():
+    try:
+        TokenUtils()
+    except OSError:
+        pytest.skip('en_core_web_sm is not installed')
+
+
+@pytest.fixture(scope='module')
+def index_dirs(tmp_path_factory):
+    root = tmp_path_factory.mktemp('shards')
+    pages_dir = str(root / 'pages')
+    os.makedirs(pages_dir)
+    pages = _pages(60)
+    for loc, text in pages.items():
+        with open(os.path.join(pages_dir, loc.replace('/', '\\')), 'w') as f:
+            f.write(f'<html><body><p>{text}</p></body></html>')
+    with open(os.path.join(pages_dir, 'bookkeeping.json'), 'w') as f:
+        json.dump({loc: f'example.com/{loc}' for loc in pages}, f)
+
+    indexer = Indexer(pages_dir, None, None)
+    indexer.construct_index()
+    indexer.save_index(str(root / 'index'))
+    Indexer(pages_dir, None, None).construct_shards(str(root / 'sharded'), 4)
+    return str(root / 'index'), str(root / 'sharded')
+
+
+async def _sharded_results(sharded_dir, scorer, rerank_depth, k):
+    pool = ShardedSearchPool(sharded_dir, None, scorer=scorer, rerank_depth=rerank_depth, result_cache_size=0)
+    try:
+        return {(query, mode): await pool.search(query, k=k, retrieval=mode) for query in QUERIES for mode in MODES}
+    finally:
+        pool.close()
+
+
+@pytest.mark.parametrize('scorer', ['classic', 'bm25f'])
+@pytest.mark.parametrize('rerank_depth', [None, 1, 5])
+@pytest.mark.parametrize('k', [2, 20])
+def test_sharded_matches_single_index(index_dirs, scorer, rerank_depth, k):
+    # With rerank_depth, the candidates reranked over all shards are the ones the
+    # single index reranks, so results match in order, ties included
+    index_dir, sharded_dir = index_dirs
+    indexer = Indexer(None, None, None)
+    indexer.load_index(index_dir)
+    engine = SearchEngine(indexer, None, result_cache_size=0, scorer=scorer, rerank_depth=rerank_depth)
+
+    sharded = asyncio.run(_sharded_results(sharded_dir, scorer, rerank_depth, k))
+    for (query, mode), response in sharded.items():
+        expected = engine.search(query, k=k, retrieval=mode)
+        if expected is None:
+            assert response is None, (query, mode)
+            continue
+        assert response[0] == expected[0], (query, mode)
+        assert [url for url, _, _, _ in response[1]] == [url for url, _, _, _ in expected[1]], (query, mode)
+        assert [score for _, _, _, score in response[1]] == pytest.approx([score for _, _, _, score in expected[1]],
+                                                                          rel=1e-12), (query, mode)
@@ -0,0 +1,176 @@
+import json
+import os
+
+import pytest
+
+from index import Indexer
+from search import SearchEngine
+import segments
+from segments import is_segmented
+from token_utils import TokenUtils
+
+# Incremental updates against a full rebuild of the same pages
+# usage: python -m pytest test_segments.py
+
+PAGES = {
+    '0/0': 'alpha beta beta beta beta',
+    '0/1': 'alpha gamma gamma gamma gamma',
+    '0/2': 'beta delta',
+    '0/3': 'gamma epsilon',
+    '0/4': 'gamma zeta',
+    '0/5': 'eta theta',
+}
+# Three more documents with beta lower its idf, which changes the norms that the
+# impact order of the first build was computed with
+ADDED = {'1/0': 'beta iota', '1/1': 'beta kappa', '1/2': 'beta lambda'}
+CHANGED = {'0/2': 'beta delta omega'}
+REMOVED = ['0/5']
+
+QUERIES = ['alpha', 'beta', 'gamma', 'alpha beta', 'beta iota', 'gamma zeta epsilon', 'omega', 'eta', 'delta beta']
+MODES = ['all', 'wand', 'impact', 'and']
+
+
+@pytest.fixture(scope='module', autouse=True)
+def spacy_model():
+    try:
+        TokenUtils()
+    except OSError:
+        pytest.skip('en_core_web_sm is not installed')
+
+
+def _write_pages(pages_dir, pages, removed=()):
+    os.makedirs(pages_dir, exist_ok=True)
+    path = os.path.join(pages_dir, 'bookkeeping.json')
+    bookkeeping = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            bookkeeping = json.load(f)
+    for loc, text in pages.items():
+        with open(os.path.join(pages_dir, loc.replace('/', '\\')), 'w') as f:
+            f.write(f'<html><body><p>{text}</p></body></html>')
+        bookkeeping[loc] = f'example.com/{loc}'
+    for loc in removed:
+        del bookkeeping[loc]
+    with open(path, 'w') as f:
+        json.dump(bookkeeping, f)
+
+
+def _build(pages_dir, index_dir, impact_ordered):
+    indexer = Indexer(pages_dir, None, None)
+    indexer.construct_index()
+    indexer.save_index(index_dir, impact_ordered)
+
+
+def _engine(index_dir):
+    indexer = Indexer(None, None, None)
+    indexer.load_index(index_dir)
+    # prune_depth=1: pruned retrieval alone picks the k candidates that get ranked
+    return SearchEngine(indexer, None, result_cache_size=0, prune_depth=1)
+
+
+def _updated_and_rebuilt(tmp_path, impact_ordered):
+    pages_dir = str(tmp_path / 'pages')
+    _write_pages(pages_dir, PAGES)
+    _build(pages_dir, str(tmp_path / 'index'), impact_ordered)
+
+    _write_pages(pages_dir, dict(ADDED, **CHANGED), REMOVED)
+    Indexer(pages_dir, None, None).update_index(str(tmp_path / 'index'))
+    _build(pages_dir, str(tmp_path / 'rebuilt'), impact_ordered)
+    return _engine(str(tmp_path / 'index')), _engine(str(tmp_path / 'rebuilt'))
+
+
+def _results(response):
+    # Doc ids differ between the two indexes, so results are compared by url; equal
+    # scores may come back in either order
+    if response is None:
+        return None
+    return response[0], sorted((url, round(score, 9)) for url, _, _, score in response[1])
+
+
+@pytest.mark.parametrize('impact_ordered', [False, True])
+def test_update_matches_rebuild(tmp_path, impact_ordered):
+    updated, rebuilt = _updated_and_rebuilt(tmp_path, impact_ordered)
+    assert updated.indexer.num_documents == rebuilt.indexer.num_documents
+    for query in QUERIES:
+        for mode in MODES:
+            expected = _results(rebuilt.search(query, k=20, retrieval=mode))
+            assert _results(updated.search(query, k=20, retrieval=mode)) == expected, (query, mode)
+
+
+def test_impact_retrieval_after_update(tmp_path):
+    # With k=1, impact retrieval hands a single candidate to the ranking: picked by
+    # the impact order of the first build, it would be 0/1 instead of 0/0
+    updated, rebuilt = _updated_and_rebuilt(tmp_path, impact_ordered=True)
+    for query in ['alpha', 'alpha omega']:
+        best = rebuilt.search(query, k=1)[1][0][0]
+        assert updated.search(query, k=1, retrieval='impact')[1][0][0] == best
+        assert rebuilt.search(query, k=1, retrieval='impact')[1][0][0] == best
+
+
+def test_rebuild_replaces_segments(tmp_path):
+    # A full rebuild into an updated directory serves the rebuilt plain index, and a
+    # server that was reading the segments follows it
+    pages_dir, index_dir = str(tmp_path / 'pages'), str(tmp_path / 'index')
+    _write_pages(pages_dir, PAGES)
+    _build(pages_dir, index_dir, False)
+    _write_pages(pages_dir, ADDED)
+    Indexer(pages_dir, None, None).update_index(index_dir)
+    serving = _engine(index_dir)
+    assert serving.search('eta', k=20) is not None
+
+    _write_pages(pages_dir, {}, REMOVED)
+    _build(pages_dir, index_dir, False)
+    assert not is_segmented(index_dir)
+    assert not [name for name in os.listdir(index_dir) if name.startswith(('seg_', 'norms_', 'stats_', 'pages_'))]
+    for engine in (_engine(index_dir), serving):
+        assert engine.search('eta', k=20) is None
+        assert engine.search('beta', k=20)[0] == 5
+
+
+def test_commit_reads_only_changed_terms(tmp_path, monkeypatch):
+    # After the first commit, a commit reads the postings of the terms of the added
+    # and deleted documents alone
+    pages_dir, index_dir = str(tmp_path / 'pages'), str(tmp_path / 'index')
+    _write_pages(pages_dir, PAGES)
+    _build(pages_dir, index_dir, False)
+    Indexer(pages_dir, None, None).update_index(index_dir)
+
+    read = set()
+    term_frequencies = segments._term_frequencies
+    monkeypatch.setattr(segments, '_term_frequencies',
+                        lambda index, token, lengths: read.add(token) or term_frequencies(index, token, lengths))
+    _write_pages(pages_dir, {'1/0': 'beta iota'})
+    Indexer(pages_dir, None, None).update_index(index_dir)
+    assert read == {'beta', 'iota'}
+
+    read.clear()
+    _write_pages(pages_dir, {}, REMOVED)
+    updated = Indexer(pages_dir, None, None)
+    updated.update_index(index_dir)
+    assert read == {'eta', 'theta'}
+    assert _engine(index_dir).search('eta', k=20) is None
+    assert updated.doc_freq('beta') == 3
+
+
+def test_open_during_commits(tmp_path, monkeypatch):
+    # A reader that read a manifest just before two more commits finds its files gone,
+    # and opens the newest index instead
+    pages_dir, index_dir = str(tmp_path / 'pages'), str(tmp_path / 'index')
+    _write_pages(pages_dir, PAGES)
+    _build(pages_dir, index_dir, False)
+    Indexer(pages_dir, None, None).update_index(index_dir)
+
+    load_manifest = segments.load_manifest
+
+    def load_before_commits(path):
+        loaded = load_manifest(path)
+        monkeypatch.setattr(segments, 'load_manifest', load_manifest)
+        for loc, text in ADDED.items():
+            _write_pages(pages_dir, {loc: text})
+            Indexer(pages_dir, None, None).update_index(index_dir)
+        return loaded
+
+    monkeypatch.setattr(segments, 'load_manifest', load_before_commits)
+    engine = _engine(index_dir)
+    assert engine.search('lambda', k=20)[0] == 1
+    assert engine.search('beta', k=20)[0] == 5
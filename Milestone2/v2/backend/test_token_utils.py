@@ -0,0 +1,35 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from token_utils import TokenUtils
+
+# usage: python -m pytest test_token_utils.py
+
+
+@pytest.fixture(scope='module')
+def utils():
+    try:
+        return TokenUtils()
+    except OSError:
+        pytest.skip('en_core_web_sm is not installed')
+
+
+def test_tokenize_threads_share_one_model(utils):
+    # Texts of very different lengths tokenized at once on one instance, as a search
+    # pool does with its engine's model
+    utils.nlp.max_length = 100
+    texts = [' '.join(['searching engines'] * n) for n in (1, 400, 3, 900, 10, 2000) * 8]
+    expected = [utils.tokenize(text) for text in texts]
+    # Switching threads often makes an interleaving between setting and checking the
+    # limit likely
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            assert list(pool.map(utils.tokenize, texts * 4)) == expected * 4
+            assert list(pool.map(lambda text: utils.tokenize_many([text, 'x'])[0], texts)) == expected
+    finally:
+        sys.setswitchinterval(interval)
+    assert utils.nlp.max_length >= max(len(text) for text in texts)
@@ -1,15 +1,37 @@
 import re
 import spacy
 import string
+import threading
+
+# Only lemmas and the stop word list are used, so the dependency parser and the
+# entity recognizer are never loaded (the lemmatizer relies on the tagger instead)
+UNUSED_COMPONENTS = ['parser', 'ner']
+LEMMA_CACHE_SIZE = 100000
 
 class TokenUtils():
-    
-    def __init__(self):
-        self.nlp = spacy.load('en_core_web_sm')
+
+    def __init__(self, full_pipeline=False, fast=False):
+        if full_pipeline:
+            self.nlp = spacy.load('en_core_web_sm')
+        else:
+            self.nlp = spacy.load('en_core_web_sm', exclude=UNUSED_COMPONENTS)
+        # fast: tokenize queries with the rule-based tokenizer and a lemma lookup table
+        self.fast = fast
+        self.lemma_lookup = {}
+        self.length_lock = threading.Lock()
+
+
+    def _allow_length(self, length):
+        # Raises spaCy's limit on text length to fit length. One instance may tokenize
+        # on several threads, so the limit only ever grows: lowering it could reject a
+        # longer text another thread is about to parse.
+        with self.length_lock:
+            if length > self.nlp.max_length:
+                self.nlp.max_length = length
 
 
     def _load_tokens(self, text):
-        self.nlp.max_length = len(text)
+        self._allow_length(len(text))
         tokens = self.nlp(text)
 
         return tokens
@@ -31,20 +53,70 @@ class TokenUtils():
     def _lemmatize(self, tokens):
         lemmatized_tokens = [token.lemma_.lower() for token in tokens]
 
-        return lemmatized_tokens                       
+        return lemmatized_tokens
 
 
     def _remove_stopwords(self, tokens):
-        stopwords = self.nlp.Defaults.stop_words   
+        stopwords = self.nlp.Defaults.stop_words
         clean_tokens = [word for word in tokens if word not in stopwords]
 
         return clean_tokens
 
 
-    def tokenize(self, text):
-        tokens = self._load_tokens(text)
+    def _clean(self, tokens):
         valid_tokens = self._remove_nonwords(tokens)
         lemmatized_tokens = self._lemmatize(valid_tokens)
         clean_tokens = self._remove_stopwords(lemmatized_tokens)
 
-        return clean_tokens
\ No newline at end of file
+        return clean_tokens
+
+
+    def tokenize(self, text):
+        tokens = self._load_tokens(text)
+
+        return self._clean(tokens)
+
+
+    def tokenize_many(self, texts, batch_size=64, n_process=1):
+        texts = list(texts)
+        self._allow_length(max([len(text) for text in texts], default=0))
+        docs = self.nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+
+        return [self._clean(tokens) for tokens in docs]
+
+
+    def _learn_lemmas(self, words):
+        lemmas = {}
+        for word, tokens in zip(words, self.nlp.pipe(words)):
+            lemmas[word] = tokens[0].lemma_.lower() if len(tokens) == 1 else word.lower()
+        if len(self.lemma_lookup) + len(words) > LEMMA_CACHE_SIZE:
+            self.lemma_lookup.clear()
+        self.lemma_lookup.update(lemmas)
+
+        return lemmas
+
+
+    def tokenize_fast(self, text):
+        # Lemmas are looked up per word instead of tagging the whole text in context;
+        # words seen for the first time are lemmatized once and cached. Lookups go
+        # through a per-call dict so a concurrent cache reset cannot drop a word.
+        words = [token.text for token in self._remove_nonwords(self.nlp.make_doc(text))]
+        lemmas = {word: self.lemma_lookup.get(word) for word in words}
+        missing = [word for word, lemma in lemmas.items() if lemma is None]
+        if missing:
+            lemmas.update(self._learn_lemmas(missing))
+        lemmatized_tokens = [lemmas[word] for word in words]
+
+        return self._remove_stopwords(lemmatized_tokens)
+
+
+    def tokenize_query(self, text):
+        if self.fast:
+            return self.tokenize_fast(text)
+        return self.tokenize(text)
+
+
+    def tokenize_queries(self, texts):
+        if self.fast:
+            return [self.tokenize_fast(text) for text in texts]
+        return self.tokenize_many(texts)